@@ -0,0 +1,91 @@
+"""Member account counters, denormalized from the loans
+
+Every member row carries how many loans the member has out, how many of
+them are overdue and the fines recorded on their loans. Whatever changes
+a loan's status or fine also changes these counters, by the same amount and
+in the same transaction, so a checkout can check the loan limit with one
+conditional UPDATE rather than counting loans. The member row is updated
+after the book and before the stats rows (see app.stats). app.jobs.reconcile recounts
+them from the loans and repairs any drift.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import case, update
+
+from app.config import settings
+from app.models.member import Member
+
+# Counters in the order of the deltas below
+COUNTERS = ("active_loans", "overdue_loans", "outstanding_fines")
+
+
+def loan_counts(status, fine_amount):
+    """What one loan adds to its member's counters"""
+    return (
+        int(status != 'returned'),
+        int(status == 'overdue'),
+        Decimal(str(fine_amount or 0)),
+    )
+
+
+class AccountChanges:
+    """Counter deltas per member, collected from loans changing state"""
+
+    def __init__(self):
+        self.deltas = defaultdict(lambda: [0, 0, Decimal(0)])
+
+    def add(self, member_id, before=None, after=None):
+        """Record a loan changing from before to after, each a
+        (status, fine_amount) pair, or None when it does not exist"""
+        delta = self.deltas[member_id]
+        for i, value in enumerate(loan_counts(*after) if after else (0, 0, 0)):
+            delta[i] += value
+        for i, value in enumerate(loan_counts(*before) if before else (0, 0, 0)):
+            delta[i] -= value
+        return self
+
+    def statement(self):
+        """A single UPDATE applying every delta, or None when there is nothing to change"""
+        deltas = {member_id: delta for member_id, delta in self.deltas.items() if any(delta)}
+        if not deltas:
+            return None
+        values = {
+            name: getattr(Member, name) + case(
+                {member_id: delta[i] for member_id, delta in deltas.items()},
+                value=Member.member_id, else_=0
+            )
+            for i, name in enumerate(COUNTERS)
+        }
+        # The counters are not part of any response, so they leave updated_at
+        # and version, and with them the member's validators, as they were
+        return (
+            update(Member)
+            .where(Member.member_id.in_(sorted(deltas)))
+            .values(updated_at=Member.updated_at, version=Member.version, **values)
+            .execution_options(synchronize_session=False)
+        )
+
+    async def apply(self, db):
+        statement = self.statement()
+        if statement is not None:
+            await db.execute(statement)
+
+
+async def take_loans(db, member_id, count=1):
+    """Count count new loans against the member, within the loan limit
+
+    Returns False, changing nothing, when they would take the member over
+    MAX_ACTIVE_LOANS. The check and the increment are one conditional UPDATE,
+    so concurrent checkouts cannot both slip under the limit.
+    """
+    condition = [Member.member_id == member_id]
+    if settings.max_active_loans > 0:
+        condition.append(Member.active_loans + count <= settings.max_active_loans)
+    result = await db.execute(
+        update(Member)
+        .where(*condition)
+        .values(active_loans=Member.active_loans + count, updated_at=Member.updated_at, version=Member.version)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
@@ -0,0 +1,169 @@
+"""Admission control: a concurrency budget per class of route
+
+Each class of request gets a number of requests it may run at once and a
+bounded queue of requests waiting for one of them. A request that finds the
+queue full, or waits longer than the queue timeout, is shed straight away
+with a 503 and a Retry-After header, rather than piling up on the database
+pool. Reporting requests therefore cannot crowd out checkouts.
+"""
+import asyncio
+from collections import deque
+from urllib.parse import parse_qs
+
+from fastapi.responses import JSONResponse
+
+from app.database import READ_METHODS
+from app.pagination import page_limit
+
+# Route classes. Bulk and reporting requests hold a connection for long, so
+# they get a small budget of their own.
+WRITES = "writes"
+READS = "reads"
+REPORTING = "reporting"
+
+# Paths served under the API routers. Anything else, such as /health and
+# /metrics, is never queued.
+API_PREFIXES = ("/books", "/authors", "/categories", "/members", "/loans", "/reservations", "/stats")
+REPORTING_SUFFIXES = ("/import", "/export", "/bulk", "/bulk-return")
+
+# Pages larger than the default page size count as reporting
+DEFAULT_PAGE_SIZE = 100
+
+
+def _page_size(scope):
+    """Rows the request can get back, as the list endpoints cap its limit"""
+    values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("limit")
+    try:
+        return page_limit(int(values[-1])) if values else 0
+    except ValueError:
+        return 0
+
+
+def route_class(scope):
+    """The class of an HTTP request, or None for requests that are never queued"""
+    path = scope["path"].rstrip("/")
+    if not path.startswith(API_PREFIXES) or scope["method"] == "OPTIONS":
+        return None
+    if path.startswith("/stats") or path.endswith(REPORTING_SUFFIXES):
+        return REPORTING
+    if scope["method"] in READ_METHODS:
+        return REPORTING if _page_size(scope) > DEFAULT_PAGE_SIZE else READS
+    return WRITES
+
+
+class Limiter:
+    """At most limit requests at once, with up to queue_size more waiting in turn"""
+
+    def __init__(self, name, limit, queue_size, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.shed = 0
+
+    async def acquire(self):
+        """Take a slot, waiting for one if need be. False when the request is shed."""
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self.waiters) >= self.queue_size:
+            self.shed += 1
+            return False
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        # release() hands a slot over by resolving the waiter with True
+        timer = loop.call_later(self.queue_timeout, lambda: waiter.done() or waiter.set_result(False))
+        try:
+            admitted = await waiter
+        except asyncio.CancelledError:
+            # The client went away; give back a slot that was already handed over
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                self.release()
+            self._forget(waiter)
+            raise
+        finally:
+            timer.cancel()
+        if not admitted:
+            self._forget(waiter)
+            self.shed += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def _forget(self, waiter):
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        """Hand the slot to the longest waiting request, or free it"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "class": self.name,
+            "limit": self.limit,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+
+class AdmissionMiddleware:
+    """Runs each HTTP request under the Limiter of its route class
+
+    Classes without a limiter are not limited. The slot is held until the
+    response is sent in full, so a streamed export keeps its slot for as
+    long as the client reads.
+    """
+
+    def __init__(self, app, limiters, retry_after=1):
+        self.app = app
+        self.limiters = limiters
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        limiter = self.limiters.get(route_class(scope)) if scope["type"] == "http" else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limiter.acquire():
+            response = JSONResponse(
+                {"detail": "Server busy, retry later"},
+                status_code=503,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+def create_limiters(settings):
+    """Limiters for the classes with a budget in settings (a limit of 0 leaves a class unlimited)"""
+    budgets = {
+        WRITES: (settings.admission_writes_limit, settings.admission_writes_queue),
+        READS: (settings.admission_reads_limit, settings.admission_reads_queue),
+        REPORTING: (settings.admission_reporting_limit, settings.admission_reporting_queue),
+    }
+    return {
+        name: Limiter(name, limit, queue_size, settings.admission_queue_timeout)
+        for name, (limit, queue_size) in budgets.items()
+        if limit > 0
+    }
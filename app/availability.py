@@ -0,0 +1,43 @@
+"""Book availability, the copies on the shelf counted by available_copies
+
+Availability is only ever changed by conditional UPDATEs that the database
+applies atomically, never by writing back a value read earlier. Concurrent
+checkouts of the same title therefore cannot oversubscribe it or lose an
+update, and 0 <= available_copies <= total_copies always holds.
+"""
+from sqlalchemy import case, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.book import Book
+
+
+async def reserve_copies(db: AsyncSession, counts):
+    """Take counts[book_id] copies of each book
+
+    Returns False when any of the books does not have enough copies left. Some
+    of the others may have been updated by then, so the caller must abandon
+    the transaction.
+    """
+    if not counts:
+        return True
+    taken = case(dict(counts), value=Book.book_id)
+    result = await db.execute(
+        update(Book)
+        .where(Book.book_id.in_(list(counts)), Book.available_copies >= taken)
+        .values(available_copies=Book.available_copies - taken)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == len(counts)
+
+
+async def release_copies(db: AsyncSession, counts):
+    """Give back counts[book_id] copies of each book, never above total_copies"""
+    if not counts:
+        return
+    available = Book.available_copies + case(dict(counts), value=Book.book_id)
+    await db.execute(
+        update(Book)
+        .where(Book.book_id.in_(list(counts)))
+        .values(available_copies=case((available > Book.total_copies, Book.total_copies), else_=available))
+        .execution_options(synchronize_session=False)
+    )
@@ -0,0 +1,215 @@
+import codecs
+import csv
+import json
+
+from fastapi import Request
+from pydantic import ValidationError
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import DBAPIError
+
+from app.config import settings
+from app.models.author import Author
+from app.models.book import Book
+from app.models.category import Category
+from app.models.member import Member
+from app.schemas.bulk import ImportReport, RowError
+from app.search import index_new_books
+
+# Keep the report bounded however many rows fail
+MAX_REPORTED_ERRORS = 1000
+
+# Separator for list values, such as author_ids, in CSV cells
+CSV_LIST_SEPARATOR = ";"
+
+
+async def _lines(stream):
+    """Decode a byte stream into lines without buffering the whole body"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in stream:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def _ndjson_records(lines):
+    row = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+            yield row, record, None
+        except ValueError as e:
+            yield row, None, f"Invalid JSON: {e}"
+
+
+async def _csv_records(lines):
+    header = None
+    row = 0
+    pending = ""
+    async for line in lines:
+        # A quoted field may span lines, so wait for its closing quote
+        pending = f"{pending}\n{line}" if pending else line
+        if pending.count('"') % 2:
+            continue
+        text, pending = pending, ""
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        # Empty cells fall back to the schema defaults
+        yield row, {name: value for name, value in zip(header, values) if value != ""}, None
+    if pending:
+        yield row + 1, None, "Unterminated quoted field"
+
+
+def read_records(request: Request):
+    """(row, record, error) for each row of a streamed NDJSON or CSV body"""
+    lines = _lines(request.stream())
+    if request.headers.get("content-type", "").startswith("text/csv"):
+        return _csv_records(lines)
+    return _ndjson_records(lines)
+
+
+def _describe(error: ValidationError):
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors()
+    )
+
+
+async def run_import(db, records, schema, insert_rows, list_fields=()):
+    """Validate streamed records and hand them to insert_rows chunk by chunk
+
+    Each chunk is inserted and committed in its own transaction. insert_rows
+    receives (row, model) pairs and returns (row, error) pairs for the rows it
+    rejected.
+    """
+    report = ImportReport()
+
+    def fail(row, error):
+        report.failed += 1
+        if len(report.errors) < MAX_REPORTED_ERRORS:
+            report.errors.append(RowError(row=row, error=error))
+
+    async def flush(chunk):
+        try:
+            rejected = await insert_rows(db, chunk)
+            await db.commit()
+        except DBAPIError as e:
+            await db.rollback()
+            rejected = [(row, f"Chunk rolled back: {e.orig}") for row, _ in chunk]
+        for row, error in rejected:
+            fail(row, error)
+        report.imported += len(chunk) - len(rejected)
+        # Nothing from a committed chunk is needed again
+        db.expunge_all()
+
+    chunk = []
+    async for row, record, error in records:
+        report.received += 1
+        if error:
+            fail(row, error)
+            continue
+        for field in list_fields:
+            if isinstance(record.get(field), str):
+                record[field] = [v for v in record[field].split(CSV_LIST_SEPARATOR) if v.strip()]
+        try:
+            chunk.append((row, schema.parse_obj(record)))
+        except ValidationError as e:
+            fail(row, _describe(e))
+            continue
+        if len(chunk) >= settings.import_batch_size:
+            await flush(chunk)
+            chunk = []
+    if chunk:
+        await flush(chunk)
+    return report
+
+
+async def insert_authors(db, rows):
+    await db.execute(insert(Author), [author.dict() for _, author in rows])
+    return []
+
+
+async def insert_members(db, rows):
+    emails = {member.email.lower() for _, member in rows}
+    existing = await db.scalars(
+        select(func.lower(Member.email)).where(func.lower(Member.email).in_(emails))
+    )
+    taken = set(existing.all())
+    rejected, values = [], []
+    for row, member in rows:
+        email = member.email.lower()
+        if email in taken:
+            rejected.append((row, "Member with this email already exists"))
+            continue
+        taken.add(email)
+        values.append(member.dict())
+    if values:
+        await db.execute(insert(Member), values)
+    return rejected
+
+
+async def insert_books(db, rows):
+    author_ids = {author_id for _, book in rows for author_id in book.author_ids}
+    category_ids = {book.category_id for _, book in rows if book.category_id is not None}
+    isbns = {book.isbn for _, book in rows if book.isbn}
+
+    authors = {}
+    if author_ids:
+        result = await db.scalars(select(Author).where(Author.author_id.in_(author_ids)))
+        authors = {author.author_id: author for author in result}
+    categories = set()
+    if category_ids:
+        result = await db.scalars(
+            select(Category.category_id).where(Category.category_id.in_(category_ids))
+        )
+        categories = set(result.all())
+    taken_isbns = set()
+    if isbns:
+        result = await db.scalars(select(Book.isbn).where(Book.isbn.in_(isbns)))
+        taken_isbns = set(result.all())
+
+    rejected, books = [], []
+    for row, book in rows:
+        missing = [author_id for author_id in book.author_ids if author_id not in authors]
+        if missing:
+            rejected.append((row, f"Author with ID {missing[0]} not found"))
+            continue
+        if book.category_id is not None and book.category_id not in categories:
+            rejected.append((row, f"Category with ID {book.category_id} not found"))
+            continue
+        if book.isbn and book.isbn in taken_isbns:
+            rejected.append((row, "Book with this ISBN already exists"))
+            continue
+        if book.isbn:
+            taken_isbns.add(book.isbn)
+        db_book = Book(
+            available_copies=book.total_copies,
+            **book.dict(exclude={"author_ids"})
+        )
+        db_book.authors = [authors[author_id] for author_id in dict.fromkeys(book.author_ids)]
+        books.append(db_book)
+
+    if books:
+        # MySQL only reports generated ids one insert at a time, so the books
+        # themselves go in row by row. Author links and search terms, which
+        # make up most of the rows, are inserted in multi-row statements.
+        db.add_all(books)
+        await db.flush()
+        await index_new_books(db, books)
+    return rejected
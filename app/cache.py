@@ -0,0 +1,150 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import settings
+
+
+class LRUCache:
+    """In-process cache bounded by entry count, with a time to live per entry"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RedisCache:
+    """Cache kept in Redis, or any server speaking its protocol, shared by all workers"""
+
+    def __init__(self, url, ttl, namespace="library:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        raw = self.client.get(self.namespace + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.namespace + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*(self.namespace + key for key in keys))
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=f"{self.namespace}{prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        # Evictions happen server side and are shared by every client
+        info = self.client.info("stats")
+        return {
+            "backend": "redis",
+            "entries": self.client.dbsize(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": info.get("evicted_keys", 0) + info.get("expired_keys", 0),
+        }
+
+
+class NullCache:
+    """Caching disabled: every lookup misses"""
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def delete_prefix(self, prefix):
+        pass
+
+    def stats(self):
+        return {"backend": "none", "entries": 0, "hits": 0, "misses": self.misses, "evictions": 0}
+
+
+def create_cache():
+    if settings.cache_backend == "redis":
+        return RedisCache(settings.cache_redis_url, settings.cache_ttl)
+    if settings.cache_backend == "memory":
+        return LRUCache(settings.cache_max_entries, settings.cache_ttl)
+    return NullCache()
+
+
+cache = create_cache()
+
+
+def entity_key(kind, ident):
+    return f"{kind}:{ident}"
+
+
+def book_keys(book_ids):
+    return [entity_key("book", book_id) for book_id in book_ids]
+
+
+# Prefix shared by every cached page of the category list
+CATEGORY_LIST_PREFIX = "categories:list:"
@@ -0,0 +1,148 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import HTTPException, Request, Response, status
+
+from app.cache import cache
+from app.database import reads_replica
+
+
+class Validators:
+    """Strong ETag and Last-Modified of one representation of a resource"""
+
+    def __init__(self, etag, last_modified=None):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @classmethod
+    def from_version(cls, key, version, variant=None):
+        """Validators for the representation at key, given its version row
+
+        variant tells apart representations of the same resource state, such
+        as different expansions. It is appended to the ETag after a dash.
+        updated_at columns are stored in UTC without a time zone.
+        """
+        digest = hashlib.sha1(repr((key, tuple(version))).encode()).hexdigest()
+        if variant:
+            digest += "-" + hashlib.sha1(variant.encode()).hexdigest()[:8]
+        stamps = [value for value in version if isinstance(value, datetime)]
+        last_modified = max(stamps).replace(tzinfo=timezone.utc, microsecond=0) if stamps else None
+        return cls(f'"{digest}"', last_modified)
+
+    def headers(self):
+        headers = {"ETag": self.etag}
+        if self.last_modified is not None:
+            headers["Last-Modified"] = format_datetime(self.last_modified, usegmt=True)
+        return headers
+
+    @classmethod
+    def from_headers(cls, headers):
+        last_modified = headers.get("Last-Modified")
+        return cls(headers["ETag"], parsedate_to_datetime(last_modified) if last_modified else None)
+
+    def not_modified(self, request: Request):
+        """Whether the client's copy, per If-None-Match or If-Modified-Since, is current"""
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or self.etag in _entity_tags(if_none_match)
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and self.last_modified is not None:
+            try:
+                return self.last_modified <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+def _entity_tags(header):
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+def detail_key(request: Request):
+    """Representation key of a detail resource, shared by its GET and PUT"""
+    return request.url.path
+
+
+def list_key(request: Request):
+    """Representation key of a list page, which depends on every query parameter"""
+    return f"{request.url.path}?{request.url.query}"
+
+
+async def row_version(db, query, not_found=None):
+    """Version row of a single resource
+
+    A missing resource gives None, or a 404 with the not_found detail.
+    """
+    row = (await db.execute(query)).first()
+    if row is None and not_found:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=not_found)
+    return tuple(row) if row is not None else None
+
+
+async def page_version(db, page):
+    """Version of a list page: the version rows of the page, in order
+
+    Totals over the page would let two writes cancel out, and a row leaving
+    the page balance one coming in, so every row's versions go into the ETag.
+    """
+    rows = (await db.execute(page)).all()
+    return tuple(value for row in rows for value in row)
+
+
+async def conditional_get(
+    request: Request, response: Response, key, load_version, load_body, cache_key=None, variant=None
+):
+    """Serve a GET, answering 304 before any row is loaded or serialized
+
+    load_version returns the version row of the representation, and load_body
+    the serializable body; it may set headers on response. With cache_key the
+    body is cached together with its validators, so a cache hit needs no
+    query at all. Only bodies read from the primary are cached: a lagging
+    replica could put back a row a write has just removed from the cache.
+    """
+    cached = cache.get(cache_key) if cache_key else None
+    if cached is None:
+        validators = Validators.from_version(key, await load_version(), variant)
+        if validators.not_modified(request):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators.headers())
+        body = await load_body()
+        cached = {"body": body, "headers": {**response.headers, **validators.headers()}}
+        if cache_key and not reads_replica(request):
+            cache.set(cache_key, cached)
+    validators = Validators.from_headers(cached["headers"])
+    if validators.not_modified(request):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators.headers())
+    response.headers.update(cached["headers"])
+    return cached["body"]
+
+
+async def check_if_match(request: Request, load_version):
+    """Reject a write with 412 when If-Match does not name the current resource state
+
+    The ETag of any variant of the resource's representation matches.
+    """
+    if_match = request.headers.get("if-match")
+    if if_match is None:
+        return
+    version = await load_version()
+    if version is None:
+        # Nothing to match, the handler reports the missing resource
+        return
+    if if_match.strip() == "*":
+        return
+    etag = Validators.from_version(detail_key(request), version).etag
+    tags = {tag.strip().split("-")[0].rstrip('"') + '"' for tag in if_match.split(",")}
+    if etag not in tags:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Resource has been modified"
+        )
+
+
+async def set_etag(request: Request, response: Response, load_version):
+    """Send the validators of the representation a write just produced"""
+    version = await load_version()
+    if version is not None:
+        response.headers.update(Validators.from_version(detail_key(request), version).headers())
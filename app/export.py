@@ -0,0 +1,117 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.bulk_import import CSV_LIST_SEPARATOR
+from app.config import settings
+from app.database import read_engines
+
+# Media types of the export formats
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+async def _sync_batches(engine, query, batch_size):
+    # Each blocking step runs in the threadpool, like ThreadedSession does
+    conn = await run_in_threadpool(engine.connect)
+    try:
+        result = await run_in_threadpool(
+            conn.execution_options(stream_results=True).execute, query
+        )
+        while True:
+            rows = await run_in_threadpool(result.fetchmany, batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        await run_in_threadpool(conn.close)
+
+
+async def _async_batches(async_engine, query, batch_size):
+    async with async_engine.connect() as conn:
+        result = await conn.stream(query)
+        async for rows in result.partitions(batch_size):
+            yield rows
+
+
+def stream_rows(query, batch_size=None):
+    """Rows of query in batches, read through a server-side cursor
+
+    The export holds its own connection for as long as the client keeps
+    reading, and never has more than one batch in memory. Exports read
+    from a replica when there is one.
+    """
+    batch_size = batch_size or settings.export_batch_size
+    query = query.execution_options(yield_per=batch_size)
+    engine, async_engine = read_engines()
+    if settings.async_db:
+        return _async_batches(async_engine, query, batch_size)
+    return _sync_batches(engine, query, batch_size)
+
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # Matches how the API renders amounts
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return CSV_LIST_SEPARATOR.join(str(v) for v in value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+async def _ndjson_chunks(batches, fields, convert):
+    async for rows in batches:
+        yield "".join(
+            json.dumps(dict(zip(fields, convert(row))), default=_json_value) + "\n"
+            for row in rows
+        )
+
+
+async def _csv_chunks(batches, fields, convert):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(fields)
+    async for rows in batches:
+        writer.writerows([_csv_value(value) for value in convert(row)] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # An empty export still gets its header
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_response(query, fmt, filename, convert=tuple):
+    """Stream the rows of query as NDJSON or CSV, one chunk per batch
+
+    The columns of query name the fields. convert turns a row into the
+    values to write, e.g. to split aggregated lists. The CSV layout is the
+    one the import endpoints read back.
+    """
+    fields = [column.key for column in query.selected_columns]
+    batches = stream_rows(query)
+    if fmt == "csv":
+        chunks = _csv_chunks(batches, fields, convert)
+    else:
+        chunks = _ndjson_chunks(batches, fields, convert)
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
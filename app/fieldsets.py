@@ -0,0 +1,182 @@
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+
+from app.models.author import Author
+from app.models.book import Book, book_authors
+from app.models.category import Category
+from app.models.loan import Loan
+from app.models.member import Member
+from app.schemas.author import AuthorResponse
+from app.schemas.book import BookResponse
+from app.schemas.category import CategoryResponse
+from app.schemas.loan import LoanResponse
+from app.schemas.member import MemberResponse
+
+
+class Embed:
+    """A nested object attached to each row, loaded for a whole page in one query
+
+    By default the objects are the rows of fieldset whose target column is in
+    the page's values of key_column. load(db, keys, names, expand) replaces
+    that lookup and returns {key: value}. Rows without a match get default.
+    """
+
+    def __init__(self, key_column, fieldset, target=None, load=None, default=None):
+        self.key_column = key_column
+        self.fieldset = fieldset
+        self.target = target
+        self.load = load
+        self.default = default
+
+    async def fetch(self, db, keys, names, expand):
+        if self.load is not None:
+            return await self.load(db, keys, names, expand)
+        return await self.fieldset.load_by(db, self.target, keys, names, expand)
+
+
+class Fieldset:
+    """Fields of a response schema, read as plain columns and built into dicts
+
+    Building responses straight from rows skips the ORM identity map and the
+    pydantic validation of every nested object, which dominate the cost of
+    large list pages. Clients can name the fields they need with ?fields=,
+    and only the columns behind them are selected. Embeds named in collapsed
+    are left out unless requested with ?fields= or ?expand=.
+    """
+
+    def __init__(self, schema, model, embeds=None, collapsed=()):
+        table_columns = model.__table__.columns
+        self.columns = {
+            name: getattr(model, name) for name in schema.__fields__ if name in table_columns
+        }
+        self.embeds = embeds or {}
+        # Dicts keep the field order of the schema
+        self.names = [name for name in schema.__fields__ if name in self.columns or name in self.embeds]
+        self.default_names = [name for name in self.names if name not in collapsed]
+
+    def parse(self, fields: Optional[str] = None, expand=None):
+        """Field names for a comma separated ?fields= value and an expand tree
+
+        Without fields, the default fields are returned, or when expand is
+        given, the columns and the expanded embeds.
+        """
+        if not fields:
+            return self.names_for(expand) if expand else self.default_names
+        requested = {name.strip() for name in fields.split(",") if name.strip()}
+        unknown = sorted(requested - set(self.names))
+        if unknown:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown field: {unknown[0]}"
+            )
+        return [name for name in self.names if name in requested or name in (expand or {})]
+
+    def parse_expand(self, expand: Optional[str]):
+        """Tree of the embeds to include at each level, from comma separated
+        dotted paths such as book.authors"""
+        tree = {}
+        for path in (expand or "").split(","):
+            path = path.strip()
+            if not path or path == "none":
+                continue
+            fieldset, node = self, tree
+            for part in path.split("."):
+                if part not in fieldset.embeds:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Cannot expand: {path}"
+                    )
+                node = node.setdefault(part, {})
+                fieldset = fieldset.embeds[part].fieldset
+        return tree
+
+    def names_for(self, expand):
+        """Columns plus the embeds in expand, or the default fields when expand is None"""
+        if expand is None:
+            return self.default_names
+        return [name for name in self.names if name in self.columns or name in expand]
+
+    def select(self, names, extra=()):
+        """Select the columns behind names, plus extra ones such as the sort key"""
+        columns = {}
+        for name in names:
+            column = self.embeds[name].key_column if name in self.embeds else self.columns[name]
+            columns.setdefault(column.key, column)
+        for column in extra:
+            columns.setdefault(column.key, column)
+        return select(*columns.values())
+
+    async def build(self, db, rows, names, expand=None):
+        """Response dicts for rows selected with select(names)
+
+        Embeds missing from expand are built with their default fields.
+        """
+        embedded = {}
+        for name in names:
+            if name in self.embeds:
+                embed = self.embeds[name]
+                nested = (expand or {}).get(name)
+                keys = {getattr(row, embed.key_column.key) for row in rows} - {None}
+                values = {}
+                if keys:
+                    values = await embed.fetch(db, keys, embed.fieldset.names_for(nested), nested)
+                embedded[name] = (embed, values)
+        items = []
+        for row in rows:
+            item = {}
+            for name in names:
+                if name in embedded:
+                    embed, values = embedded[name]
+                    item[name] = values.get(getattr(row, embed.key_column.key), embed.default)
+                else:
+                    item[name] = getattr(row, name)
+            items.append(item)
+        return items
+
+    async def load_by(self, db, column, keys, names=None, expand=None):
+        """Dicts of the rows whose column is in keys, keyed by it"""
+        names = names or self.default_names
+        rows = (await db.execute(self.select(names, [column]).where(column.in_(keys)))).all()
+        items = await self.build(db, rows, names, expand)
+        return {getattr(row, column.key): item for row, item in zip(rows, items)}
+
+
+def expand_paths(tree, prefix=""):
+    """Canonical comma separated form of an expand tree, e.g. book.authors,member"""
+    paths = []
+    for name in sorted(tree):
+        path = prefix + name
+        paths.append(expand_paths(tree[name], path + ".") if tree[name] else path)
+    return ",".join(paths)
+
+
+author_fields = Fieldset(AuthorResponse, Author)
+category_fields = Fieldset(CategoryResponse, Category)
+member_fields = Fieldset(MemberResponse, Member)
+
+
+async def _book_authors(db, book_ids, names, expand):
+    rows = (await db.execute(
+        author_fields.select(names, [book_authors.c.book_id])
+        .join(book_authors, book_authors.c.author_id == Author.author_id)
+        .where(book_authors.c.book_id.in_(book_ids))
+    )).all()
+    authors = {}
+    for row, author in zip(rows, await author_fields.build(db, rows, names, expand)):
+        authors.setdefault(row.book_id, []).append(author)
+    return authors
+
+
+book_fields = Fieldset(BookResponse, Book, {
+    "category": Embed(Book.category_id, category_fields, target=Category.category_id),
+    # Books without authors get an empty list
+    "authors": Embed(Book.book_id, author_fields, load=_book_authors, default=()),
+})
+
+# Loans carry only the ids of their book and member unless expanded
+loan_fields = Fieldset(LoanResponse, Loan, {
+    "book": Embed(Loan.book_id, book_fields, target=Book.book_id),
+    "member": Embed(Loan.member_id, member_fields, target=Member.member_id),
+}, collapsed=("book", "member"))
@@ -0,0 +1,12 @@
+from datetime import date
+from decimal import Decimal
+
+FINE_PER_DAY = Decimal('0.50')  # $0.50 per day
+
+
+def calculate_fine(due_date: date, return_date: date):
+    """Fine for a book returned (or still out) on return_date, or None when it is not late"""
+    if due_date < return_date:
+        days_late = (return_date - due_date).days
+        return days_late * FINE_PER_DAY
+    return None
@@ -0,0 +1,157 @@
+"""Idempotency-Key support for create endpoints
+
+A client that sends an Idempotency-Key header with a POST can safely retry
+it: the outcome of the first request with that key is kept for
+IDEMPOTENCY_TTL seconds, and a retry gets the same response back without
+running the handler again. A retry that arrives while the first request is
+still running waits for it.
+
+With CACHE_BACKEND=redis the outcomes, and the claim on a key while its
+first request runs, are kept in Redis, so a retry that reaches another
+worker is answered too. Otherwise they are kept per process, like the memory
+cache, and only a single worker can guarantee that a retry does not run again.
+"""
+import asyncio
+import hashlib
+import json
+import secrets
+
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+
+from app.cache import LRUCache, RedisCache
+from app.config import settings
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+# Set on responses replayed from the store
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(body):
+    """Digest of a request body model, to tell a retry from a different request reusing its key"""
+    raw = json.dumps(jsonable_encoder(body), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """Outcomes of requests by idempotency key, bounded in count and age, kept in this process
+
+    An outcome is the response body, or the status and detail of an
+    HTTPException below 500. Server errors are not kept, so retrying after
+    one runs the request again. outcomes is the cache the outcomes are kept in.
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.in_flight = {}
+
+    async def run(self, key, body, response, execute, response_model):
+        """The result of execute(), or the stored outcome of the request first sent with key
+
+        key is namespaced by the caller, body is the request body model and
+        the result of execute() is serialized with response_model.
+        """
+        if key is None:
+            return await execute()
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{IDEMPOTENCY_HEADER} is longer than {MAX_KEY_LENGTH} characters"
+            )
+        digest = fingerprint(body)
+        while True:
+            outcome = self.outcomes.get(key)
+            if outcome is not None:
+                response.headers[REPLAYED_HEADER] = "true"
+                return self._replay(outcome, digest)
+            if self.claim(key):
+                break
+            await self.wait(key)
+
+        try:
+            result = jsonable_encoder(response_model.validate(await execute()))
+            self.outcomes.set(key, (digest, result, None))
+            return result
+        except HTTPException as e:
+            if e.status_code < 500:
+                self.outcomes.set(key, (digest, None, (e.status_code, e.detail)))
+            raise
+        finally:
+            self.release(key)
+
+    def claim(self, key):
+        """Take key for this request to run, False while another request with it runs"""
+        if key in self.in_flight:
+            return False
+        self.in_flight[key] = asyncio.get_running_loop().create_future()
+        return True
+
+    async def wait(self, key):
+        """Wait for the request running with key to finish"""
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            # Shielded, so that a waiter going away does not cancel the first request's future
+            await asyncio.shield(pending)
+
+    def release(self, key):
+        self.in_flight.pop(key).set_result(None)
+
+    @staticmethod
+    def _replay(outcome, digest):
+        stored_digest, result, error = outcome
+        if stored_digest != digest:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"{IDEMPOTENCY_HEADER} was already used with a different request"
+            )
+        if error is not None:
+            raise HTTPException(status_code=error[0], detail=error[1], headers={REPLAYED_HEADER: "true"})
+        return result
+
+
+class SharedIdempotencyStore(IdempotencyStore):
+    """Outcomes and claims kept in Redis, shared by every worker
+
+    A claim is a key set only if absent, which expires after
+    IDEMPOTENCY_CLAIM_TIMEOUT seconds in case its worker dies. Requests
+    waiting for it poll the store until the outcome appears or the claim goes.
+    """
+
+    # Deletes the claim only if it still holds this request's token, not one
+    # taken by another request after it expired
+    RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, outcomes, claim_timeout, poll_interval=0.05):
+        super().__init__(outcomes)
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.tokens = {}
+
+    def _claim_key(self, key):
+        return f"{self.outcomes.namespace}claim:{key}"
+
+    def claim(self, key):
+        token = secrets.token_hex(16)
+        if not self.outcomes.client.set(self._claim_key(key), token, nx=True, ex=self.claim_timeout):
+            return False
+        self.tokens[key] = token
+        return True
+
+    async def wait(self, key):
+        await asyncio.sleep(self.poll_interval)
+
+    def release(self, key):
+        self.outcomes.client.eval(self.RELEASE, 1, self._claim_key(key), self.tokens.pop(key))
+
+
+def create_store():
+    if settings.cache_backend == "redis":
+        outcomes = RedisCache(settings.cache_redis_url, settings.idempotency_ttl, namespace="library:idempotency:")
+        return SharedIdempotencyStore(outcomes, settings.idempotency_claim_timeout)
+    return IdempotencyStore(LRUCache(settings.idempotency_max_keys, settings.idempotency_ttl))
+
+
+idempotency = create_store()
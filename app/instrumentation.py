@@ -0,0 +1,220 @@
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from app.metrics import COUNT_BUCKETS, Histogram, PrometheusText
+
+# Route label of requests that matched no route, so that probes for random
+# paths cannot grow the number of series
+UNMATCHED_ROUTE = "unmatched"
+
+
+class RequestStats:
+    """SQL statements run, and time spent in them, on behalf of one request"""
+
+    __slots__ = ("scope", "statements", "db_time")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.statements = 0
+        self.db_time = 0.0
+
+    @property
+    def route(self):
+        """Method and path template, once the request has been routed"""
+        route = self.scope.get("route")
+        return f"{self.scope['method']} {route.path}" if route is not None else None
+
+
+# Stats of the request being served. The threadpool and the async engine's
+# greenlets both run with a copy of the request's context, and the copy
+# refers to the same RequestStats.
+current_request = ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine, slow_queries=None):
+    """Time the statements run on engine
+
+    Their count and duration go to the request being served, and those
+    slower than the threshold of slow_queries, a SlowQueryLog, are logged.
+    """
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.query_started = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context.query_started
+        stats = current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += duration
+        if (
+            slow_queries is not None
+            and duration >= slow_queries.threshold
+            and context.execution_options.get("slow_query_log", True)
+        ):
+            slow_queries.record(statement, parameters, duration,
+                                stats.route if stats is not None else None, executemany)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class RouteMetrics:
+    """Latency, status and SQL cost of the requests to one route"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statements = Histogram(COUNT_BUCKETS)
+        self.db_time = Histogram()
+        self.responses = {}
+
+
+class RequestMetrics:
+    """Per-route request metrics, keyed by method and path template"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def route(self, method, path):
+        key = (method, path)
+        metrics = self.routes.get(key)
+        if metrics is None:
+            with self._lock:
+                metrics = self.routes.setdefault(key, RouteMetrics())
+        return metrics
+
+    def observe(self, method, path, status_code, elapsed, stats):
+        metrics = self.route(method, path)
+        metrics.latency.observe(elapsed)
+        metrics.statements.observe(stats.statements)
+        metrics.db_time.observe(stats.db_time)
+        with self._lock:
+            metrics.responses[status_code] = metrics.responses.get(status_code, 0) + 1
+
+    def write(self, out):
+        """Add the request metrics to a PrometheusText"""
+        out.sample("library_http_requests_in_flight", "gauge",
+                   "Requests being served", self.in_flight)
+        routes = sorted(self.routes.items())
+        for (method, path), metrics in routes:
+            out.histogram("library_http_request_duration_seconds",
+                          "Time to serve a request, including streaming the body",
+                          metrics.latency.snapshot(), {"method": method, "route": path})
+        for (method, path), metrics in routes:
+            for status_code, count in sorted(metrics.responses.copy().items()):
+                out.sample("library_http_responses_total", "counter", "Responses sent, by status",
+                           count, {"method": method, "route": path, "status": status_code})
+        for (method, path), metrics in routes:
+            out.histogram("library_db_statements_per_request",
+                          "SQL statements run to serve a request",
+                          metrics.statements.snapshot(), {"method": method, "route": path})
+        for (method, path), metrics in routes:
+            out.histogram("library_db_time_per_request_seconds",
+                          "Time spent in SQL statements to serve a request",
+                          metrics.db_time.snapshot(), {"method": method, "route": path})
+
+
+request_metrics = RequestMetrics()
+
+
+class InstrumentationMiddleware:
+    """Records latency, status and SQL cost of every HTTP request by route
+
+    Written as plain ASGI middleware so that streamed responses are timed to
+    their last chunk. With server_timing, responses carry a Server-Timing
+    header with the SQL statements and DB time up to the start of the
+    response.
+    """
+
+    def __init__(self, app, metrics=request_metrics, server_timing=False):
+        self.app = app
+        self.metrics = metrics
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    elapsed = (time.perf_counter() - started) * 1000
+                    timing = (
+                        f'db;dur={stats.db_time * 1000:.2f};desc="{stats.statements} statements", '
+                        f"app;dur={elapsed:.2f}"
+                    )
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", timing.encode("latin-1"))
+                    ]
+            await send(message)
+
+        self.metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.in_flight -= 1
+            current_request.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else UNMATCHED_ROUTE
+            self.metrics.observe(scope["method"], path, status_code,
+                                 time.perf_counter() - started, stats)
+
+
+def render_metrics(pool, cache_stats, slow_query_stats=None, replica_stats=(), admission_stats=()):
+    """Prometheus text exposition of the request, admission, pool, cache, slow query and replica metrics"""
+    out = PrometheusText()
+    request_metrics.write(out)
+    for limiter in admission_stats:
+        labels = {"class": limiter["class"]}
+        out.sample("library_admission_limit", "gauge", "Requests of the class allowed to run at once",
+                   limiter["limit"], labels)
+        out.sample("library_admission_active", "gauge", "Requests of the class running", limiter["active"], labels)
+        out.sample("library_admission_queue_depth", "gauge", "Requests of the class waiting for a slot",
+                   limiter["queued"], labels)
+        out.sample("library_admission_admitted_total", "counter", "Requests of the class let through",
+                   limiter["admitted"], labels)
+        out.sample("library_admission_shed_total", "counter",
+                   "Requests of the class turned away with a 503", limiter["shed"], labels)
+    if slow_query_stats is not None:
+        out.sample("library_db_slow_queries_total", "counter",
+                   "Statements slower than the slow query threshold", slow_query_stats["slow_queries"])
+
+    out.sample("library_db_pool_size", "gauge", "Connections kept open by the pool", pool["size"])
+    out.sample("library_db_pool_checked_out", "gauge", "Connections in use", pool["checked_out"])
+    out.sample("library_db_pool_overflow", "gauge", "Connections open beyond the pool size", pool["overflow"])
+    out.sample("library_db_pool_saturation", "gauge",
+               "Share of the pool capacity in use", pool["saturation"])
+    out.sample("library_db_pool_timeouts_total", "counter",
+               "Checkouts that gave up waiting for a connection", pool["timeouts"])
+    out.histogram("library_db_pool_wait_seconds", "Time a checkout waited for a connection",
+                  pool["wait_time"])
+
+    for replica in replica_stats:
+        labels = {"replica": replica["name"]}
+        out.sample("library_db_replica_up", "gauge", "Whether the read replica is in rotation",
+                   int(replica["healthy"]), labels)
+        out.sample("library_db_replica_ejections_total", "counter",
+                   "Times the read replica was ejected after a connection failure", replica["ejections"], labels)
+        out.sample("library_db_replica_pool_checked_out", "gauge", "Replica connections in use",
+                   replica["pool"]["checked_out"], labels)
+
+    backend = {"backend": cache_stats["backend"]}
+    for key in ("hits", "misses", "evictions"):
+        out.sample(f"library_cache_{key}_total", "counter", f"Entity cache {key}",
+                   cache_stats.get(key), backend)
+    out.sample("library_cache_entries", "gauge", "Entries in the entity cache",
+               cache_stats.get("entries"), backend)
+    return out.render()
@@ -0,0 +1 @@
+# This file intentionally left empty
\ No newline at end of file
@@ -0,0 +1,53 @@
+"""Expire holds that were not collected in time
+
+A copy put aside for a member waits HOLD_PICKUP_DAYS on the hold shelf.
+After that the hold expires and the copy goes to the next member in line,
+or back on the shelf. Run daily from cron:
+
+    python -m app.jobs.holds [--date YYYY-MM-DD]
+
+or inside the app by setting HOLD_EXPIRY_INTERVAL (seconds).
+"""
+import argparse
+import asyncio
+import logging
+from datetime import date
+
+from app.cache import book_keys, cache
+from app.database import session_scope
+from app.reservations import expire_holds
+
+logger = logging.getLogger(__name__)
+
+
+async def expire(today=None):
+    """Expire the overdue holds in one transaction, returning how many books they held"""
+    async with session_scope() as db:
+        book_ids = await expire_holds(db, today)
+        await db.commit()
+    cache.delete(*book_keys(book_ids))
+    logger.info("Hold expiry: holds of %s books expired", len(book_ids))
+    return len(book_ids)
+
+
+async def run_periodically(interval):
+    """Background task expiring holds every interval seconds"""
+    while True:
+        try:
+            await expire()
+        except Exception:
+            logger.exception("Hold expiry failed")
+        await asyncio.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expire holds that were not collected in time")
+    parser.add_argument("--date", type=date.fromisoformat, help="expire as of this date (default: today)")
+    args = parser.parse_args()
+
+    books = asyncio.run(expire(args.date))
+    print(f"Expired holds on {books} books")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Mark overdue loans and accrue their fines
+
+Run nightly from cron:
+
+    python -m app.jobs.overdue [--date YYYY-MM-DD] [--batch-size N]
+
+or inside the app by setting OVERDUE_SWEEP_INTERVAL (seconds).
+"""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import date
+
+from sqlalchemy import case, select, update
+from starlette.concurrency import run_in_threadpool
+
+from app.accounts import AccountChanges
+from app.config import settings
+from app.fines import calculate_fine
+from app.models.loan import Loan
+
+logger = logging.getLogger(__name__)
+
+# Loans whose book has not come back yet
+OUTSTANDING = ('borrowed', 'overdue')
+
+
+def sweep_overdue(engine, today=None, batch_size=None, pause=0.0):
+    """Mark loans past their due date overdue and set their accrued fines
+
+    Works through the loans in primary key order, batch_size at a time. Each
+    batch is one short transaction: a SELECT of ids and due dates, then a
+    single UPDATE that sets every fine through a CASE, and one more that
+    adjusts the account counters of the members. No ORM objects are loaded
+    and locks are only held briefly. pause seconds are slept between
+    batches to leave room for other traffic.
+    """
+    today = today or date.today()
+    batch_size = batch_size or settings.overdue_sweep_batch_size
+    start = time.perf_counter()
+    updated = batches = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            # Locked, so that the account changes below match what is updated
+            rows = connection.execute(
+                select(Loan.loan_id, Loan.due_date, Loan.member_id, Loan.status, Loan.fine_amount)
+                .where(
+                    Loan.status.in_(OUTSTANDING),
+                    Loan.due_date < today,
+                    Loan.loan_id > last_id
+                )
+                .order_by(Loan.loan_id)
+                .limit(batch_size)
+                .with_for_update()
+            ).all()
+            if not rows:
+                break
+            fines = {row.loan_id: calculate_fine(row.due_date, today) for row in rows}
+            accounts = AccountChanges()
+            for row in rows:
+                accounts.add(row.member_id, (row.status, row.fine_amount), ('overdue', fines[row.loan_id]))
+            result = connection.execute(
+                update(Loan)
+                .where(Loan.loan_id.in_(list(fines)), Loan.status.in_(OUTSTANDING))
+                .values(status='overdue', fine_amount=case(fines, value=Loan.loan_id))
+            )
+            statement = accounts.statement()
+            if statement is not None:
+                connection.execute(statement)
+        updated += result.rowcount
+        batches += 1
+        last_id = rows[-1].loan_id
+        if pause:
+            time.sleep(pause)
+    elapsed = time.perf_counter() - start
+    stats = {
+        "date": today.isoformat(),
+        "updated": updated,
+        "batches": batches,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(updated / elapsed) if elapsed else 0,
+    }
+    logger.info("Overdue sweep: %s", stats)
+    return stats
+
+
+async def run_periodically(engine, interval):
+    """Background task running the sweep every interval seconds"""
+    while True:
+        try:
+            await run_in_threadpool(sweep_overdue, engine)
+        except Exception:
+            logger.exception("Overdue sweep failed")
+        await asyncio.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark overdue loans and accrue their fines")
+    parser.add_argument("--date", type=date.fromisoformat, help="sweep as of this date (default: today)")
+    parser.add_argument("--batch-size", type=int, help="loans updated per transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+
+    from app.database import engine
+
+    stats = sweep_overdue(engine, today=args.date, batch_size=args.batch_size, pause=args.pause)
+    print(
+        f"Updated {stats['updated']} overdue loans as of {stats['date']} in {stats['batches']} batches, "
+        f"{stats['seconds']}s ({stats['rows_per_second']} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
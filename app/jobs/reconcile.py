@@ -0,0 +1,112 @@
+"""Recount member account counters from the loans and repair any drift
+
+Run it after loans were changed outside the API, or from cron now and then
+to catch drift:
+
+    python -m app.jobs.reconcile [--dry-run] [--batch-size N]
+"""
+import argparse
+import logging
+import time
+from decimal import Decimal
+
+from sqlalchemy import case, func, select, update
+
+from app.accounts import COUNTERS
+from app.models.loan import Loan
+from app.models.member import Member
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal("0.01")
+
+
+def _counts(row):
+    return (int(row.active_loans or 0), int(row.overdue_loans or 0),
+            Decimal(str(row.outstanding_fines or 0)).quantize(CENT))
+
+
+def reconcile_accounts(engine, batch_size=1000, repair=True):
+    """Compare each member's counters with their loans, fixing those that differ
+
+    Works through the members in primary key order, batch_size at a time,
+    one transaction per batch. The batch's member rows are locked first, so
+    a checkout or return running meanwhile either lands before the recount
+    or applies its change on top of the repaired value.
+    """
+    start = time.perf_counter()
+    checked = drifted = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            members = connection.execute(
+                select(Member.member_id, *(getattr(Member, name) for name in COUNTERS))
+                .where(Member.member_id > last_id)
+                .order_by(Member.member_id)
+                .limit(batch_size)
+                .with_for_update()
+            ).all()
+            if not members:
+                break
+            ids = [row.member_id for row in members]
+            actual = {
+                row.member_id: _counts(row)
+                for row in connection.execute(
+                    select(
+                        Loan.member_id,
+                        func.sum(case((Loan.status != 'returned', 1), else_=0)).label("active_loans"),
+                        func.sum(case((Loan.status == 'overdue', 1), else_=0)).label("overdue_loans"),
+                        func.sum(Loan.fine_amount).label("outstanding_fines"),
+                    )
+                    .where(Loan.member_id.in_(ids))
+                    .group_by(Loan.member_id)
+                )
+            }
+            fixes = {}
+            for row in members:
+                stored = _counts(row)
+                expected = actual.get(row.member_id, (0, 0, Decimal(0).quantize(CENT)))
+                if stored != expected:
+                    logger.warning("Member %s counters %s, loans give %s", row.member_id, stored, expected)
+                    fixes[row.member_id] = expected
+            if fixes and repair:
+                connection.execute(
+                    update(Member)
+                    .where(Member.member_id.in_(list(fixes)))
+                    .values(updated_at=Member.updated_at, version=Member.version, **{
+                        name: case({member_id: values[i] for member_id, values in fixes.items()},
+                                   value=Member.member_id)
+                        for i, name in enumerate(COUNTERS)
+                    })
+                )
+        checked += len(members)
+        drifted += len(fixes)
+        last_id = members[-1].member_id
+    stats = {
+        "checked": checked,
+        "drifted": drifted,
+        "repaired": drifted if repair else 0,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    logger.info("Account reconciliation: %s", stats)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recount member account counters from the loans")
+    parser.add_argument("--batch-size", type=int, default=1000, help="members checked per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="report drift without repairing it")
+    args = parser.parse_args()
+
+    from app.database import engine
+
+    stats = reconcile_accounts(engine, batch_size=args.batch_size, repair=not args.dry_run)
+    print(
+        f"Checked {stats['checked']} members, {stats['drifted']} drifted, "
+        f"{stats['repaired']} repaired, {stats['seconds']}s"
+    )
+    return 1 if stats["drifted"] and args.dry_run else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,12 +1,21 @@
+import asyncio
+
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-
-from app.database import engine, Base, get_db
-from app.routes import authors, books, categories, members, loans
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-# Create tables in the database
-Base.metadata.create_all(bind=engine)
+from app.admission import AdmissionMiddleware, create_limiters
+from app.cache import cache
+from app.config import settings
+from app.database import async_engine, engine, get_pool_status, get_primary_db, replicas
+from app.instrumentation import InstrumentationMiddleware, instrument_engine, render_metrics
+from app.jobs import holds, overdue
+from app.migrations import check_schema
+from app.slow_queries import SlowQueryLog
+from app.routes import authors, books, categories, members, loans, reservations, stats
 
 # Initialize FastAPI application
 app = FastAPI(
@@ -15,6 +24,12 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Admission control per route class. Added before CORS, so that shed requests
+# still get the CORS headers.
+limiters = create_limiters(settings) if settings.admission_control else {}
+if limiters:
+    app.add_middleware(AdmissionMiddleware, limiters=limiters, retry_after=settings.admission_retry_after)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -24,12 +39,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Slow statements are explained on the sync engine, whichever engine ran them
+slow_queries = None
+if settings.slow_query_threshold > 0:
+    slow_queries = SlowQueryLog(engine, settings.slow_query_threshold, settings.slow_query_explain_limit)
+
+# Per-route latency and SQL cost. Added last, so it wraps CORS and times it too.
+# The middleware also tells the slow query log which route ran a statement.
+if settings.metrics_enabled or slow_queries is not None:
+    instrument_engine(engine, slow_queries)
+    if async_engine is not None:
+        instrument_engine(async_engine.sync_engine, slow_queries)
+    for replica in replicas.replicas:
+        for sync_engine in replica.sync_engines:
+            instrument_engine(sync_engine, slow_queries)
+if settings.metrics_enabled:
+    app.add_middleware(InstrumentationMiddleware, server_timing=settings.server_timing)
+
 # Include routers
 app.include_router(authors.router)
 app.include_router(books.router)
 app.include_router(categories.router)
 app.include_router(members.router)
 app.include_router(loans.router)
+app.include_router(reservations.router)
+app.include_router(stats.router)
+
+
+@app.on_event("startup")
+async def check_schema_version():
+    """Read the schema version once, instead of creating tables on import"""
+    await run_in_threadpool(check_schema, engine, settings.auto_migrate)
+
+
+@app.on_event("startup")
+async def start_background_jobs():
+    """Schedule the overdue sweep and hold expiry when intervals are configured, and the replica health checks"""
+    if settings.overdue_sweep_interval > 0:
+        app.state.overdue_sweep = asyncio.create_task(
+            overdue.run_periodically(engine, settings.overdue_sweep_interval)
+        )
+    if settings.hold_expiry_interval > 0:
+        app.state.hold_expiry = asyncio.create_task(holds.run_periodically(settings.hold_expiry_interval))
+    if len(replicas):
+        await replicas.check()
+        app.state.replica_checks = asyncio.create_task(
+            replicas.run_checks(settings.replica_check_interval)
+        )
+
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    for name in ("overdue_sweep", "hold_expiry", "replica_checks"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
 
 
 @app.get("/", tags=["Root"])
@@ -42,11 +106,41 @@ def read_root():
 
 
 @app.get("/health", tags=["Health"])
-def health_check(db: Session = Depends(get_db)):
-    """Health check endpoint to verify database connection"""
+async def health_check(db: AsyncSession = Depends(get_primary_db)):
+    """Health check endpoint to verify the primary database connection, pool saturation and replicas"""
+    pool = get_pool_status()
+    pool_summary = {key: pool[key] for key in ("checked_out", "overflow", "saturation", "timeouts")}
     try:
         # Execute a simple query to test DB connection
-        db.execute("SELECT 1")
-        return {"status": "healthy", "database": "connected"}
+        await db.execute(text("SELECT 1"))
+        health = {"status": "healthy", "database": "connected", "pool": pool_summary}
     except Exception as e:
-        return {"status": "unhealthy", "database": "disconnected", "error": str(e)}
\ No newline at end of file
+        health = {"status": "unhealthy", "database": "disconnected", "error": str(e), "pool": pool_summary}
+    if len(replicas):
+        health["replicas"] = {replica["name"]: replica["healthy"] for replica in replicas.status()}
+    return health
+
+
+@app.get("/health/pool", tags=["Health"])
+def pool_statistics():
+    """Live connection pool statistics, including the checkout wait time histogram"""
+    status = get_pool_status()
+    if len(replicas):
+        status["replicas"] = replicas.status()
+    return status
+
+
+@app.get("/health/cache", tags=["Health"])
+def cache_statistics():
+    """Hit, miss and eviction counters of the entity cache"""
+    return cache.stats()
+
+
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+def metrics():
+    """Request, connection pool and cache metrics in the Prometheus text format"""
+    return PlainTextResponse(
+        render_metrics(get_pool_status(), cache.stats(), slow_queries and slow_queries.stats(),
+                       replicas.status(), [limiter.stats() for limiter in limiters.values()]),
+        media_type="text/plain; version=0.0.4",
+    )
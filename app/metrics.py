@@ -0,0 +1,82 @@
+import bisect
+import threading
+
+# Upper bounds, in seconds, suited to connection waits and request latencies
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Thread-safe histogram of observations over fixed buckets"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Cumulative bucket counts keyed by upper bound, plus sum and count"""
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        buckets = {}
+        cumulative = 0
+        for bound, n in zip(self.buckets + ("+Inf",), counts):
+            cumulative += n
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "sum": total, "count": count}
+
+
+# Observations are counts, such as SQL statements per request
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class PrometheusText:
+    """Builds a Prometheus text exposition, one metric family at a time"""
+
+    def __init__(self):
+        self.lines = []
+        self._declared = set()
+
+    def _declare(self, name, kind, help):
+        if name not in self._declared:
+            self._declared.add(name)
+            self.lines.append(f"# HELP {name} {help}")
+            self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name, kind, help, value, labels=None):
+        """A gauge or counter value"""
+        if value is None:
+            return
+        self._declare(name, kind, help)
+        self.lines.append(f"{name}{_labels(labels)} {value}")
+
+    def histogram(self, name, help, snapshot, labels=None):
+        """A Histogram.snapshot()"""
+        self._declare(name, "histogram", help)
+        labels = labels or {}
+        for bound, count in snapshot["buckets"].items():
+            self.lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {count}")
+        self.lines.append(f"{name}_sum{_labels(labels)} {snapshot['sum']}")
+        self.lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
@@ -0,0 +1,391 @@
+"""Versioned schema migrations
+
+The schema_version table holds a single row with the number of the last
+migration applied. Bring a database up to date with:
+
+    python -m app.migrations [--target VERSION]
+
+The app itself only reads that row when it starts, and refuses to serve a
+database whose schema is behind the code, unless AUTO_MIGRATE is set.
+"""
+import argparse
+import logging
+import sys
+
+from sqlalchemy import (
+    DECIMAL, TIMESTAMP, CheckConstraint, Column, Date, Enum, ForeignKey, Index, Integer, MetaData,
+    String, Table, Text, func, inspect, literal_column, select, update
+)
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+)
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+# The migrations spell out their own tables rather than reading the models,
+# so that replaying an old migration always builds the schema of its version.
+# Never edit these definitions; later changes go in new migrations.
+
+# updated_at as the version 1 models declared it
+TIMESTAMP_6 = TIMESTAMP().with_variant(mysql.TIMESTAMP(fsp=6), "mysql")
+
+
+def _updated_at():
+    return Column("updated_at", TIMESTAMP_6, server_default=func.now(literal_column("6")))
+
+
+def _created_at():
+    return Column("created_at", TIMESTAMP, server_default=func.now())
+
+
+def version_1_tables():
+    """The tables as migration 1 creates them, on a metadata of their own"""
+    metadata = MetaData()
+    Table(
+        "authors", metadata,
+        Column("author_id", Integer, primary_key=True, index=True, autoincrement=True),
+        Column("first_name", String(100), nullable=False),
+        Column("last_name", String(100), nullable=False),
+        Column("birth_date", Date, nullable=True),
+        Column("nationality", String(100), nullable=True),
+        Column("biography", Text, nullable=True),
+        _created_at(),
+        _updated_at(),
+    )
+    Table(
+        "categories", metadata,
+        Column("category_id", Integer, primary_key=True, index=True, autoincrement=True),
+        Column("name", String(100), nullable=False, unique=True),
+        Column("description", Text, nullable=True),
+        _created_at(),
+        _updated_at(),
+    )
+    Table(
+        "books", metadata,
+        Column("book_id", Integer, primary_key=True, index=True, autoincrement=True),
+        Column("title", String(255), nullable=False),
+        Column("isbn", String(20), unique=True, nullable=True),
+        Column("publication_year", Integer, nullable=True),
+        Column("publisher", String(150), nullable=True),
+        Column("total_copies", Integer, nullable=False),
+        Column("available_copies", Integer, nullable=False),
+        Column("category_id", Integer, ForeignKey("categories.category_id"), nullable=True),
+        _created_at(),
+        _updated_at(),
+        CheckConstraint(
+            "available_copies >= 0 AND available_copies <= total_copies",
+            name="ck_books_available_copies"
+        ),
+        Index("idx_books_title", "title"),
+        Index("idx_books_category", "category_id"),
+    )
+    Table(
+        "book_authors", metadata,
+        Column("book_id", Integer, ForeignKey("books.book_id"), primary_key=True),
+        Column("author_id", Integer, ForeignKey("authors.author_id"), primary_key=True),
+        Index("idx_book_authors_author", "author_id", "book_id"),
+    )
+    Table(
+        "members", metadata,
+        Column("member_id", Integer, primary_key=True, index=True, autoincrement=True),
+        Column("first_name", String(100), nullable=False),
+        Column("last_name", String(100), nullable=False),
+        Column("email", String(150), unique=True, nullable=False),
+        Column("phone", String(20), nullable=True),
+        Column("address", Text, nullable=True),
+        Column("membership_date", Date, nullable=False, server_default=func.current_date()),
+        Column(
+            "membership_status", Enum('active', 'expired', 'suspended', name='membership_status'),
+            nullable=False
+        ),
+        Column("active_loans", Integer, nullable=False, server_default="0"),
+        Column("overdue_loans", Integer, nullable=False, server_default="0"),
+        Column("outstanding_fines", DECIMAL(10, 2), nullable=False, server_default="0"),
+        _created_at(),
+        _updated_at(),
+        Index("idx_members_name", "last_name", "first_name"),
+    )
+    Table(
+        "loans", metadata,
+        Column("loan_id", Integer, primary_key=True, index=True, autoincrement=True),
+        Column("book_id", Integer, ForeignKey("books.book_id"), nullable=False),
+        Column("member_id", Integer, ForeignKey("members.member_id"), nullable=False),
+        Column("loan_date", Date, nullable=False, server_default=func.current_date()),
+        Column("due_date", Date, nullable=False),
+        Column("return_date", Date, nullable=True),
+        Column("status", Enum('borrowed', 'returned', 'overdue', name='loan_status'), nullable=False),
+        Column("fine_amount", DECIMAL(10, 2), nullable=False),
+        _created_at(),
+        _updated_at(),
+        Index("idx_loans_status", "status"),
+        Index("idx_loans_dates", "loan_date", "due_date", "return_date"),
+        Index("idx_loans_member_status", "member_id", "status"),
+        Index("idx_loans_book_status", "book_id", "status"),
+        Index("idx_loans_due_date", "due_date"),
+    )
+    Table(
+        "book_search_terms", metadata,
+        Column("term", String(64), primary_key=True),
+        Column("book_id", Integer, ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True),
+        Column("weight", Integer, nullable=False),
+        Index("idx_book_search_terms_book", "book_id"),
+    )
+    Table(
+        "book_loan_stats", metadata,
+        Column("book_id", Integer, ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True),
+        Column("loans", Integer, nullable=False),
+        Column("active_loans", Integer, nullable=False),
+        Index("idx_book_loan_stats_loans", "loans"),
+    )
+    Table(
+        "category_daily_loans", metadata,
+        Column("category_id", Integer, ForeignKey("categories.category_id", ondelete="CASCADE"), primary_key=True),
+        Column("day", Date, primary_key=True),
+        Column("loans", Integer, nullable=False),
+        Index("idx_category_daily_loans_day", "day"),
+    )
+    Table(
+        "daily_circulation", metadata,
+        Column("day", Date, primary_key=True),
+        Column("loans", Integer, nullable=False),
+        Column("returns", Integer, nullable=False),
+    )
+    return metadata
+
+
+def _add_column(connection, column):
+    """Add a column to its existing table"""
+    table = column.table.name
+    if connection.dialect.name == "sqlite" and column.server_default is not None \
+            and not isinstance(column.server_default.arg, str):
+        # SQLite only adds columns with constant defaults, so fill it in afterwards
+        plain = Column(column.name, column.type, nullable=True)
+        connection.exec_driver_sql(
+            f"ALTER TABLE {table} ADD COLUMN {CreateColumn(plain).compile(dialect=connection.dialect)}"
+        )
+        connection.execute(column.table.update().values({column.name: column.server_default.arg}))
+        return
+    connection.exec_driver_sql(
+        f"ALTER TABLE {table} ADD COLUMN {CreateColumn(column).compile(dialect=connection.dialect)}"
+    )
+
+
+def add_missing(connection, tables):
+    """Add the columns and indexes of tables that the database lacks, returning the added columns"""
+    inspector = inspect(connection)
+    added = []
+    for table in tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                _add_column(connection, column)
+                added.append(column)
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+    return added
+
+
+def create_tables(connection):
+    # Tables a database created before migrations already has are left alone
+    version_1_tables().create_all(connection)
+
+
+def catch_up_unversioned(connection):
+    """Databases created by create_all before migrations existed lack the
+    updated_at stamps, the member account counters and the list filter
+    indexes. New tables, such as the stats ones, came with migration 1."""
+    tables = version_1_tables().tables
+    members, loans = tables["members"], tables["loans"]
+    names = ("authors", "books", "categories", "members", "loans", "book_authors")
+    added = {column.name for column in add_missing(connection, [tables[name] for name in names])
+             if column.table.name == "members"}
+    if "active_loans" in added:
+        # The counters gate checkouts, so they are filled in right away
+        counted = select(func.count()).where(loans.c.member_id == members.c.member_id)
+        connection.execute(update(members).values(
+            active_loans=counted.where(loans.c.status != 'returned').scalar_subquery(),
+            overdue_loans=counted.where(loans.c.status == 'overdue').scalar_subquery(),
+            outstanding_fines=select(func.coalesce(func.sum(loans.c.fine_amount), 0))
+            .where(loans.c.member_id == members.c.member_id).scalar_subquery(),
+        ))
+
+
+def create_reservations(connection):
+    metadata = MetaData()
+    # Only referenced by the foreign keys, which need the tables on the metadata
+    Table("books", metadata, Column("book_id", Integer, primary_key=True))
+    Table("members", metadata, Column("member_id", Integer, primary_key=True))
+    reservations = Table(
+        "reservations", metadata,
+        Column("reservation_id", Integer, primary_key=True, autoincrement=True),
+        Column("book_id", Integer, ForeignKey("books.book_id", ondelete="CASCADE"), nullable=False),
+        Column("member_id", Integer, ForeignKey("members.member_id", ondelete="CASCADE"), nullable=False),
+        Column("reservation_date", Date, nullable=False, server_default=func.current_date()),
+        Column("ready_date", Date, nullable=True),
+        Column("expiry_date", Date, nullable=True),
+        Column(
+            "status", Enum('active', 'ready', 'fulfilled', 'expired', 'cancelled', name='reservation_status'),
+            nullable=False
+        ),
+        _created_at(),
+        _updated_at(),
+        Index("idx_reservations_queue", "book_id", "status", "reservation_id"),
+        Index("idx_reservations_member", "member_id", "status"),
+        Index("idx_reservations_expiry", "status", "expiry_date"),
+    )
+    # Databases created by migration 1 of an earlier release may have it already
+    reservations.create(connection, checkfirst=True)
+
+
+def widen_updated_at(connection):
+    """Databases created before updated_at kept microseconds still have
+    TIMESTAMP(0) stamps on MySQL. The other dialects keep them already."""
+    if connection.dialect.name != "mysql":
+        return
+    inspector = inspect(connection)
+    for name in ("authors", "books", "categories", "members", "loans", "reservations"):
+        column = next(column for column in inspector.get_columns(name) if column["name"] == "updated_at")
+        if getattr(column["type"], "fsp", None) == 6:
+            continue
+        table = Table(name, MetaData(), _updated_at())
+        connection.exec_driver_sql(
+            f"ALTER TABLE {name} MODIFY COLUMN "
+            f"{CreateColumn(table.c.updated_at).compile(dialect=connection.dialect)}"
+        )
+
+
+def add_row_versions(connection):
+    # Existing rows all start at version 1, like new ones
+    for name in ("authors", "books", "categories", "members", "loans"):
+        table = Table(name, MetaData(), Column("version", Integer, nullable=False, server_default="1"))
+        _add_column(connection, table.c.version)
+
+
+def add_loan_categories(connection):
+    """Loans record the category their book had at checkout. Existing loans
+    get the book's current category, the best guess left."""
+    metadata = MetaData()
+    loans = Table("loans", metadata, Column("book_id", Integer), Column("category_id", Integer, nullable=True))
+    books = Table("books", metadata, Column("book_id", Integer), Column("category_id", Integer))
+    _add_column(connection, loans.c.category_id)
+    connection.execute(update(loans).values(
+        category_id=select(books.c.category_id).where(books.c.book_id == loans.c.book_id).scalar_subquery()
+    ))
+
+
+def binary_search_terms(connection):
+    """Search terms were compared under MySQL's default collation, which
+    folds accents and case. The other dialects compare them byte for byte."""
+    if connection.dialect.name != "mysql":
+        return
+    column = next(column for column in inspect(connection).get_columns("book_search_terms")
+                  if column["name"] == "term")
+    if getattr(column["type"], "collation", None) == "utf8mb4_bin":
+        return
+    table = Table(
+        "book_search_terms", MetaData(),
+        Column("term", mysql.VARCHAR(64, charset="utf8mb4", collation="utf8mb4_bin"), nullable=False),
+    )
+    connection.exec_driver_sql(
+        f"ALTER TABLE book_search_terms MODIFY COLUMN "
+        f"{CreateColumn(table.c.term).compile(dialect=connection.dialect)}"
+    )
+
+
+# (version, description, upgrade). Append new migrations, never edit applied ones.
+MIGRATIONS = [
+    (1, "Create tables", create_tables),
+    (2, "Add updated_at, member account counters and list filter indexes", catch_up_unversioned),
+    (3, "Add reservations", create_reservations),
+    (4, "Keep microseconds in updated_at on MySQL", widen_updated_at),
+    (5, "Add row versions for ETags", add_row_versions),
+    (6, "Record the category of each loan", add_loan_categories),
+    (7, "Compare search terms byte for byte on MySQL", binary_search_terms),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def read_version(connection):
+    """The schema version, 0 when the database has never been migrated"""
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def migrate(engine, target=LATEST_VERSION):
+    """Apply the pending migrations up to target, each in its own transaction"""
+    with engine.begin() as connection:
+        version = read_version(connection)
+        schema_version.create(connection, checkfirst=True)
+    for number, description, upgrade in MIGRATIONS:
+        if version < number <= target:
+            with engine.begin() as connection:
+                upgrade(connection)
+                connection.execute(schema_version.delete())
+                connection.execute(schema_version.insert().values(version=number))
+            logger.info("Migrated schema to version %s: %s", number, description)
+            version = number
+    return version
+
+
+def check_schema(engine, auto_migrate=False):
+    """Startup check: one read of the version row
+
+    A database that cannot be reached is only logged, so the app still comes
+    up and reports it on /health. A schema behind the code is migrated when
+    auto_migrate is set, and refused otherwise.
+    """
+    try:
+        connection = engine.connect()
+    except DBAPIError as e:
+        logger.warning("Database unavailable at startup, schema version not checked: %s", e)
+        return None
+    with connection:
+        try:
+            version = connection.execute(select(schema_version.c.version)).scalar() or 0
+        except DBAPIError:
+            # No schema_version table yet
+            version = 0
+    if version < LATEST_VERSION:
+        if not auto_migrate:
+            raise SchemaOutOfDate(
+                f"Database schema is at version {version}, the app needs {LATEST_VERSION}. "
+                "Run python -m app.migrations, or set AUTO_MIGRATE=true."
+            )
+        version = migrate(engine)
+    elif version > LATEST_VERSION:
+        logger.warning("Database schema version %s is newer than this app's %s", version, LATEST_VERSION)
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--target", type=int, default=LATEST_VERSION, help="migrate up to this version")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from app.database import engine
+
+    with engine.connect() as connection:
+        before = read_version(connection)
+    after = migrate(engine, args.target)
+    print(f"Schema version {before} -> {after}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,4 +3,7 @@ from app.models.author import Author
 from app.models.book import Book
 from app.models.category import Category
 from app.models.member import Member
-from app.models.loan import Loan
\ No newline at end of file
+from app.models.loan import Loan
+from app.models.search import BookSearchTerm
+from app.models.stats import BookLoanStats, CategoryDailyLoans, DailyCirculation
+from app.models.reservation import Reservation
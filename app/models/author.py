@@ -1,7 +1,7 @@
 from sqlalchemy import Column, Integer, String, Date, Text, TIMESTAMP, func
 from sqlalchemy.orm import relationship
 
-from app.database import Base
+from app.database import Base, UpdateTimestamp, next_version, update_time
 
 
 class Author(Base):
@@ -14,7 +14,8 @@ class Author(Base):
     nationality = Column(String(100), nullable=True)
     biography = Column(Text, nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    updated_at = Column(UpdateTimestamp, server_default=update_time(), onupdate=update_time())
+    version = Column(Integer, nullable=False, server_default="1", onupdate=next_version())
 
     # Relationships
     books = relationship("Book", secondary="book_authors", back_populates="authors")
\ No newline at end of file
@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, func, Table
+from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, func, Table, CheckConstraint, Index
 from sqlalchemy.orm import relationship
 
-from app.database import Base
+from app.database import Base, UpdateTimestamp, next_version, update_time
 
 
 # Association table for the many-to-many relationship between books and authors
@@ -9,7 +9,9 @@ book_authors = Table(
     "book_authors",
     Base.metadata,
     Column("book_id", Integer, ForeignKey("books.book_id"), primary_key=True),
-    Column("author_id", Integer, ForeignKey("authors.author_id"), primary_key=True)
+    Column("author_id", Integer, ForeignKey("authors.author_id"), primary_key=True),
+    # The primary key serves lookups by book, this one the books of an author
+    Index("idx_book_authors_author", "author_id", "book_id"),
 )
 
 
@@ -25,9 +27,20 @@ class Book(Base):
     available_copies = Column(Integer, nullable=False, default=1)
     category_id = Column(Integer, ForeignKey("categories.category_id"), nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    updated_at = Column(UpdateTimestamp, server_default=update_time(), onupdate=update_time())
+    version = Column(Integer, nullable=False, server_default="1", onupdate=next_version())
 
-    # Relationships
-    category = relationship("Category", back_populates="books")
-    authors = relationship("Author", secondary=book_authors, back_populates="books")
-    loans = relationship("Loan", back_populates="book")
\ No newline at end of file
+    # Relationships. category and authors are always loaded up front by the
+    # queries that need them; lazy loading them would issue a query per book.
+    category = relationship("Category", back_populates="books", lazy="raise_on_sql")
+    authors = relationship("Author", secondary=book_authors, back_populates="books", lazy="raise_on_sql")
+    loans = relationship("Loan", back_populates="book")
+
+    __table_args__ = (
+        CheckConstraint(
+            "available_copies >= 0 AND available_copies <= total_copies",
+            name="ck_books_available_copies"
+        ),
+        Index("idx_books_title", "title"),
+        Index("idx_books_category", "category_id"),
+    )
\ No newline at end of file
@@ -1,7 +1,7 @@
 from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, func
 from sqlalchemy.orm import relationship
 
-from app.database import Base
+from app.database import Base, UpdateTimestamp, next_version, update_time
 
 
 class Category(Base):
@@ -11,7 +11,8 @@ class Category(Base):
     name = Column(String(100), nullable=False, unique=True)
     description = Column(Text, nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    updated_at = Column(UpdateTimestamp, server_default=update_time(), onupdate=update_time())
+    version = Column(Integer, nullable=False, server_default="1", onupdate=next_version())
 
     # Relationships
     books = relationship("Book", back_populates="category")
\ No newline at end of file
@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, ForeignKey, Date, Enum, DECIMAL, TIMESTAMP, func
+from sqlalchemy import Column, Integer, ForeignKey, Date, Enum, DECIMAL, TIMESTAMP, func, Index
 from sqlalchemy.orm import relationship
 
-from app.database import Base
+from app.database import Base, UpdateTimestamp, next_version, update_time
 
 
 class Loan(Base):
@@ -19,9 +19,23 @@ class Loan(Base):
         nullable=False
     )
     fine_amount = Column(DECIMAL(10, 2), default=0.00, nullable=False)
+    # The book's category at checkout, which the loan counts towards in the
+    # stats. A record of the past rather than a reference, so no foreign key.
+    category_id = Column(Integer, nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    updated_at = Column(UpdateTimestamp, server_default=update_time(), onupdate=update_time())
+    version = Column(Integer, nullable=False, server_default="1", onupdate=next_version())
 
-    # Relationships
-    book = relationship("Book", back_populates="loans")
-    member = relationship("Member", back_populates="loans")
\ No newline at end of file
+    # Relationships. Loaded up front by the queries that need them, never lazily.
+    book = relationship("Book", back_populates="loans", lazy="raise_on_sql")
+    member = relationship("Member", back_populates="loans", lazy="raise_on_sql")
+
+    __table_args__ = (
+        Index("idx_loans_status", "status"),
+        Index("idx_loans_dates", "loan_date", "due_date", "return_date"),
+        # The list endpoints filter a member's or a book's loans by status,
+        # and page through all loans in due date order
+        Index("idx_loans_member_status", "member_id", "status"),
+        Index("idx_loans_book_status", "book_id", "status"),
+        Index("idx_loans_due_date", "due_date"),
+    )
\ No newline at end of file
@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, Date, Enum, TIMESTAMP, func
+from sqlalchemy import Column, Integer, String, Text, Date, Enum, DECIMAL, TIMESTAMP, func, Index
 from sqlalchemy.orm import relationship
 
-from app.database import Base
+from app.database import Base, UpdateTimestamp, next_version, update_time
 
 
 class Member(Base):
@@ -19,8 +19,17 @@ class Member(Base):
         default='active',
         nullable=False
     )
+    # Account counters, kept in step with the member's loans (see app.accounts)
+    active_loans = Column(Integer, nullable=False, default=0, server_default="0")
+    overdue_loans = Column(Integer, nullable=False, default=0, server_default="0")
+    outstanding_fines = Column(DECIMAL(10, 2), nullable=False, default=0, server_default="0")
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    updated_at = Column(UpdateTimestamp, server_default=update_time(), onupdate=update_time())
+    version = Column(Integer, nullable=False, server_default="1", onupdate=next_version())
 
     # Relationships
-    loans = relationship("Loan", back_populates="member")
\ No newline at end of file
+    loans = relationship("Loan", back_populates="member")
+
+    __table_args__ = (
+        Index("idx_members_name", "last_name", "first_name"),
+    )
\ No newline at end of file
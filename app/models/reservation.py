@@ -0,0 +1,31 @@
+from sqlalchemy import Column, Integer, ForeignKey, Date, Enum, TIMESTAMP, func, Index
+
+from app.database import Base, UpdateTimestamp, update_time
+
+
+class Reservation(Base):
+    __tablename__ = "reservations"
+
+    reservation_id = Column(Integer, primary_key=True, autoincrement=True)
+    book_id = Column(Integer, ForeignKey("books.book_id", ondelete="CASCADE"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.member_id", ondelete="CASCADE"), nullable=False)
+    reservation_date = Column(Date, nullable=False, server_default=func.current_date())
+    # Set when a copy is put aside for the member, who has until expiry_date to collect it
+    ready_date = Column(Date, nullable=True)
+    expiry_date = Column(Date, nullable=True)
+    # active: waiting in line, ready: a copy is on the hold shelf
+    status = Column(
+        Enum('active', 'ready', 'fulfilled', 'expired', 'cancelled', name='reservation_status'),
+        default='active',
+        nullable=False
+    )
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(UpdateTimestamp, server_default=update_time(), onupdate=update_time())
+
+    __table_args__ = (
+        # A book's line: its active reservations in the order they were placed
+        Index("idx_reservations_queue", "book_id", "status", "reservation_id"),
+        Index("idx_reservations_member", "member_id", "status"),
+        # Ready holds by collection deadline, for the expiry job
+        Index("idx_reservations_expiry", "status", "expiry_date"),
+    )
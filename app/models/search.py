@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
+from sqlalchemy.dialects import mysql
+
+from app.database import Base
+
+# Terms compare byte for byte. MySQL's default collation would treat "cafe"
+# and "café" as the same key, and order them in a way prefix ranges miss.
+SearchTerm = String(64).with_variant(mysql.VARCHAR(64, charset="utf8mb4", collation="utf8mb4_bin"), "mysql")
+
+
+class BookSearchTerm(Base):
+    """Inverted index entry: a search term and a book it occurs in"""
+    __tablename__ = "book_search_terms"
+
+    term = Column(SearchTerm, primary_key=True)
+    book_id = Column(Integer, ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    # Relevance of the term for the book, higher for titles than publishers
+    weight = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        Index("idx_book_search_terms_book", "book_id"),
+    )
@@ -0,0 +1,39 @@
+from sqlalchemy import Column, Date, ForeignKey, Index, Integer
+
+from app.database import Base
+
+
+class BookLoanStats(Base):
+    """Loans of a book, kept up to date by the loan endpoints"""
+    __tablename__ = "book_loan_stats"
+
+    book_id = Column(Integer, ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    # Every loan ever made, and those not returned yet
+    loans = Column(Integer, nullable=False, default=0)
+    active_loans = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("idx_book_loan_stats_loans", "loans"),
+    )
+
+
+class CategoryDailyLoans(Base):
+    """Loans of the books of a category made on one day"""
+    __tablename__ = "category_daily_loans"
+
+    category_id = Column(Integer, ForeignKey("categories.category_id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("idx_category_daily_loans_day", "day"),
+    )
+
+
+class DailyCirculation(Base):
+    """Loans made and returned on one day"""
+    __tablename__ = "daily_circulation"
+
+    day = Column(Date, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0)
+    returns = Column(Integer, nullable=False, default=0)
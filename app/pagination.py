@@ -0,0 +1,83 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy import and_, or_
+
+from app.config import settings
+
+# Response header carrying the cursor of the page after the current one
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def _to_json(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _from_json(column, value):
+    python_type = column.type.python_type
+    if python_type in (date, datetime):
+        return python_type.fromisoformat(value)
+    return python_type(value)
+
+
+def encode_cursor(values):
+    """Opaque cursor for the sort key values of the last row of a page"""
+    raw = json.dumps([_to_json(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, columns):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("cursor does not match the sort key")
+        return [_from_json(column, value) for column, value in zip(columns, values)]
+    except (binascii.Error, TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+def _after(columns, values):
+    """Rows that sort strictly after values, spelled out so indexes are used"""
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*equal, column > value))
+    return or_(*clauses)
+
+
+def page_limit(limit):
+    """limit, clamped between 1 and MAX_PAGE_SIZE"""
+    return max(1, min(limit, settings.max_page_size))
+
+
+def paginate(query, columns, cursor=None, skip=0, limit=100):
+    """Order query by columns and seek past cursor, or skip rows when no cursor is given
+
+    Seeking lets the database start reading right after the previous page, so
+    deep pages cost the same as the first one. Offset is kept for existing
+    clients. Pages never exceed MAX_PAGE_SIZE rows.
+    """
+    query = query.order_by(*columns)
+    if cursor:
+        query = query.filter(_after(columns, decode_cursor(cursor, columns)))
+    elif skip:
+        query = query.offset(skip)
+    return query.limit(page_limit(limit))
+
+
+def set_next_cursor(response: Response, rows, columns, limit):
+    """Point the client at the next page when this one came back full"""
+    if rows and len(rows) == page_limit(limit):
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            [getattr(last, column.key) for column in columns]
+        )
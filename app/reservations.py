@@ -0,0 +1,144 @@
+"""Reservations: a first come, first served line of members per book
+
+A member reserves a book that has no copy on the shelf and joins its line.
+A copy that comes back goes straight to the member first in line, inside
+the transaction that returned it: their reservation becomes ready, and the
+copy stays off the shelf until they collect it or the hold expires. Only
+copies that nobody is waiting for go back to available_copies.
+
+The line is read through idx_reservations_queue, (book_id, status,
+reservation_id), so finding the next member is an index seek, and a
+member's place in line is a count over the range of the index ahead of
+them, never a scan of all reservations.
+"""
+from collections import Counter
+from datetime import date, timedelta
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.orm import aliased
+
+from app.availability import release_copies
+from app.config import settings
+from app.models.book import Book
+from app.models.reservation import Reservation
+
+# Reservations still waiting for, or holding, a copy
+OPEN = ('active', 'ready')
+
+
+def queue_position():
+    """Place in line of an active reservation, 1 for the next to be served, NULL otherwise"""
+    ahead = aliased(Reservation)
+    return case(
+        (
+            Reservation.status == 'active',
+            select(func.count())
+            .where(
+                ahead.book_id == Reservation.book_id,
+                ahead.status == 'active',
+                ahead.reservation_id <= Reservation.reservation_id
+            )
+            .scalar_subquery()
+        ),
+        else_=None
+    )
+
+
+def reservation_query():
+    """Select reservations with their place in line"""
+    return select(*Reservation.__table__.columns, queue_position().label("position"))
+
+
+def next_in_line(book_id, count):
+    """Ids of the count active reservations of a book placed first"""
+    return (
+        select(Reservation.reservation_id)
+        .where(Reservation.book_id == book_id, Reservation.status == 'active')
+        .order_by(Reservation.reservation_id)
+        .limit(count)
+    )
+
+
+def pickup_deadline(today):
+    return today + timedelta(days=settings.hold_pickup_days)
+
+
+async def lock_books(db, book_ids):
+    """Lock the book rows, in id order
+
+    Whatever joins, leaves or serves a book's line locks the book first, so
+    a copy coming back cannot miss a member joining the line at the same
+    moment, and the locks are always taken in the same order.
+    """
+    await db.execute(
+        select(Book.book_id).where(Book.book_id.in_(sorted(book_ids))).order_by(Book.book_id).with_for_update()
+    )
+
+
+async def open_reservations(db, member_id, book_ids):
+    """The member's open reservations of the books, by book id, locked"""
+    result = await db.scalars(
+        select(Reservation)
+        .where(
+            Reservation.member_id == member_id,
+            Reservation.book_id.in_(list(book_ids)),
+            Reservation.status.in_(OPEN)
+        )
+        .with_for_update()
+    )
+    return {reservation.book_id: reservation for reservation in result}
+
+
+async def return_copies(db, counts, today=None):
+    """Put counts[book_id] copies of each book back into circulation
+
+    Each copy goes to the next member in its book's line, whose reservation
+    becomes ready to collect. The copies left over go back on the shelf.
+    """
+    if not counts:
+        return
+    today = today or date.today()
+    await lock_books(db, counts)
+    ready = []
+    shelved = Counter()
+    for book_id in sorted(counts):
+        ids = (await db.scalars(next_in_line(book_id, counts[book_id]).with_for_update())).all()
+        ready.extend(ids)
+        if counts[book_id] > len(ids):
+            shelved[book_id] = counts[book_id] - len(ids)
+    if ready:
+        await db.execute(
+            update(Reservation)
+            .where(Reservation.reservation_id.in_(ready))
+            .values(status='ready', ready_date=today, expiry_date=pickup_deadline(today))
+            .execution_options(synchronize_session=False)
+        )
+    await release_copies(db, shelved)
+
+
+async def expire_holds(db, today=None):
+    """Expire the ready holds not collected by their expiry date, passing their copies on
+
+    Returns the ids of the books whose holds expired. The caller commits.
+    """
+    today = today or date.today()
+    overdue = select(Reservation.reservation_id, Reservation.book_id).where(
+        Reservation.status == 'ready', Reservation.expiry_date < today
+    )
+    book_ids = {row.book_id for row in (await db.execute(overdue)).all()}
+    if not book_ids:
+        return []
+    # Books first, in the same order as everything else that serves a line
+    await lock_books(db, book_ids)
+    expired = (await db.execute(overdue.where(Reservation.book_id.in_(sorted(book_ids))).with_for_update())).all()
+    if not expired:
+        return []
+    await db.execute(
+        update(Reservation)
+        .where(Reservation.reservation_id.in_([row.reservation_id for row in expired]), Reservation.status == 'ready')
+        .values(status='expired')
+        .execution_options(synchronize_session=False)
+    )
+    copies = Counter(row.book_id for row in expired)
+    await return_copies(db, copies, today)
+    return sorted(copies)
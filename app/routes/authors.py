@@ -1,10 +1,19 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, Query
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import get_db
+from app.bulk_import import insert_authors, read_records, run_import
+from app.cache import book_keys, cache, entity_key
+from app.conditional import check_if_match, conditional_get, detail_key, list_key, page_version, row_version, set_etag
+from app.fieldsets import author_fields
+from app.pagination import paginate, set_next_cursor
 from app.models.author import Author
+from app.schemas.bulk import ImportReport
 from app.schemas.author import AuthorCreate, AuthorUpdate, AuthorResponse
+from app.search import author_book_ids, reindex_books
+from app.versions import author_version_query, bump_book_versions
 
 router = APIRouter(
     prefix="/authors",
@@ -13,8 +22,12 @@ router = APIRouter(
 )
 
 
+def author_version(author_id: int):
+    return author_version_query().filter(Author.author_id == author_id)
+
+
 @router.post("/", response_model=AuthorResponse, status_code=status.HTTP_201_CREATED)
-def create_author(author: AuthorCreate, db: Session = Depends(get_db)):
+async def create_author(author: AuthorCreate, db: AsyncSession = Depends(get_db)):
     db_author = Author(
         first_name=author.first_name,
         last_name=author.last_name,
@@ -23,28 +36,68 @@ def create_author(author: AuthorCreate, db: Session = Depends(get_db)):
         biography=author.biography
     )
     db.add(db_author)
-    db.commit()
-    db.refresh(db_author)
+    await db.commit()
+    await db.refresh(db_author)
     return db_author
 
 
-@router.get("/", response_model=List[AuthorResponse])
-def read_authors(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    authors = db.query(Author).offset(skip).limit(limit).all()
-    return authors
+@router.post("/import", response_model=ImportReport)
+async def import_authors(request: Request, db: AsyncSession = Depends(get_db)):
+    """Bulk import authors from a streamed NDJSON body, or CSV when sent as text/csv"""
+    return await run_import(db, read_records(request), AuthorCreate, insert_authors)
+
+
+@router.get("/", responses={200: {"model": List[AuthorResponse]}})
+async def read_authors(
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    order = [Author.author_id]
+    names = author_fields.parse(fields)
+    
+    async def load_authors():
+        query = author_fields.select(names, order)
+        rows = (await db.execute(paginate(query, order, cursor, skip, limit))).all()
+        set_next_cursor(response, rows, order, limit)
+        return await author_fields.build(db, rows, names)
+    
+    return await conditional_get(
+        request, response, list_key(request),
+        lambda: page_version(db, paginate(author_version_query(), order, cursor, skip, limit)),
+        load_authors
+    )
 
 
 @router.get("/{author_id}", response_model=AuthorResponse)
-def read_author(author_id: int, db: Session = Depends(get_db)):
-    db_author = db.query(Author).filter(Author.author_id == author_id).first()
-    if db_author is None:
-        raise HTTPException(status_code=404, detail="Author not found")
-    return db_author
+async def read_author(author_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    async def load_author():
+        db_author = await db.get(Author, author_id)
+        if db_author is None:
+            raise HTTPException(status_code=404, detail="Author not found")
+        return jsonable_encoder(AuthorResponse.from_orm(db_author))
+    
+    return await conditional_get(
+        request, response, detail_key(request),
+        lambda: row_version(db, author_version(author_id), "Author not found"), load_author,
+        cache_key=entity_key("author", author_id)
+    )
 
 
 @router.put("/{author_id}", response_model=AuthorResponse)
-def update_author(author_id: int, author: AuthorUpdate, db: Session = Depends(get_db)):
-    db_author = db.query(Author).filter(Author.author_id == author_id).first()
+async def update_author(
+    author_id: int,
+    author: AuthorUpdate,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    await check_if_match(request, lambda: row_version(db, author_version(author_id).with_for_update()))
+    db_author = await db.get(Author, author_id)
     if db_author is None:
         raise HTTPException(status_code=404, detail="Author not found")
     
@@ -52,17 +105,30 @@ def update_author(author_id: int, author: AuthorUpdate, db: Session = Depends(ge
     for key, value in update_data.items():
         setattr(db_author, key, value)
     
-    db.commit()
-    db.refresh(db_author)
+    # Author names are indexed with their books
+    book_ids = await author_book_ids(db, author_id)
+    if update_data.keys() & {"first_name", "last_name"}:
+        await reindex_books(db, book_ids)
+    
+    await db.commit()
+    # Books embed their authors
+    cache.delete(entity_key("author", author_id), *book_keys(book_ids))
+    await db.refresh(db_author)
+    await set_etag(request, response, lambda: row_version(db, author_version(author_id)))
     return db_author
 
 
 @router.delete("/{author_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_author(author_id: int, db: Session = Depends(get_db)):
-    db_author = db.query(Author).filter(Author.author_id == author_id).first()
+async def delete_author(author_id: int, db: AsyncSession = Depends(get_db)):
+    db_author = await db.get(Author, author_id)
     if db_author is None:
         raise HTTPException(status_code=404, detail="Author not found")
     
-    db.delete(db_author)
-    db.commit()
+    book_ids = await author_book_ids(db, author_id)
+    await db.delete(db_author)
+    await db.flush()
+    await bump_book_versions(db, book_ids)
+    await reindex_books(db, book_ids)
+    await db.commit()
+    cache.delete(entity_key("author", author_id), *book_keys(book_ids))
     return None
\ No newline at end of file
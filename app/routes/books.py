@@ -1,11 +1,24 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session, joinedload
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, Query
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
 
 from app.database import get_db
-from app.models.book import Book
+from app.bulk_import import insert_books, read_records, run_import
+from app.cache import cache, entity_key
+from app.conditional import check_if_match, conditional_get, detail_key, list_key, page_version, row_version, set_etag
+from app.export import export_response
+from app.fieldsets import book_fields
+from app.pagination import page_limit, paginate, set_next_cursor
+from app.reservations import lock_books, return_copies
+from app.models.book import Book, book_authors
 from app.models.author import Author
+from app.schemas.bulk import ImportReport
 from app.schemas.book import BookCreate, BookUpdate, BookResponse
+from app.search import index_book, search_book_ids, unindex_book
+from app.versions import book_version_query
 
 router = APIRouter(
     prefix="/books",
@@ -14,8 +27,59 @@ router = APIRouter(
 )
 
 
+def book_query():
+    """Select books with everything BookResponse needs loaded up front"""
+    return select(Book).options(
+        joinedload(Book.category),
+        selectinload(Book.authors)
+    )
+
+
+async def get_book_or_404(db: AsyncSession, book_id: int, reload: bool = False):
+    query = book_query().filter(Book.book_id == book_id)
+    if reload:
+        query = query.execution_options(populate_existing=True)
+    db_book = await db.scalar(query)
+    if db_book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return db_book
+
+
+async def get_authors_or_404(db: AsyncSession, author_ids: List[int]):
+    """Fetch authors in one query, keeping the order they were given in"""
+    authors = {}
+    if author_ids:
+        result = await db.scalars(select(Author).filter(Author.author_id.in_(author_ids)))
+        authors = {author.author_id: author for author in result}
+    for author_id in author_ids:
+        if author_id not in authors:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Author with ID {author_id} not found"
+            )
+    return [authors[author_id] for author_id in dict.fromkeys(author_ids)]
+
+
+def filter_books(query, title: Optional[str], author_id: Optional[int], category_id: Optional[int]):
+    if title:
+        query = query.filter(Book.title.ilike(f"%{title}%"))
+    if author_id:
+        # Driven by the author's rows of book_authors, rather than an EXISTS
+        # probe for every book
+        query = query.filter(Book.book_id.in_(
+            select(book_authors.c.book_id).where(book_authors.c.author_id == author_id)
+        ))
+    if category_id:
+        query = query.filter(Book.category_id == category_id)
+    return query
+
+
+def book_version(book_id: int):
+    return book_version_query().filter(Book.book_id == book_id)
+
+
 @router.post("/", response_model=BookResponse, status_code=status.HTTP_201_CREATED)
-def create_book(book: BookCreate, db: Session = Depends(get_db)):
+async def create_book(book: BookCreate, db: AsyncSession = Depends(get_db)):
     # Create new book
     db_book = Book(
         title=book.title,
@@ -28,89 +92,164 @@ def create_book(book: BookCreate, db: Session = Depends(get_db)):
     )
     
     # Add authors
-    for author_id in book.author_ids:
-        author = db.query(Author).filter(Author.author_id == author_id).first()
-        if not author:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Author with ID {author_id} not found"
-            )
-        db_book.authors.append(author)
+    db_book.authors = await get_authors_or_404(db, book.author_ids)
     
     db.add(db_book)
-    db.commit()
-    db.refresh(db_book)
-    return db_book
+    await db.flush()
+    await index_book(db, db_book)
+    await db.commit()
+    return await get_book_or_404(db, db_book.book_id, reload=True)
+
+
+@router.post("/import", response_model=ImportReport)
+async def import_books(request: Request, db: AsyncSession = Depends(get_db)):
+    """Bulk import books from a streamed NDJSON body, or CSV when sent as text/csv"""
+    return await run_import(db, read_records(request), BookCreate, insert_books, list_fields=("author_ids",))
 
 
-@router.get("/", response_model=List[BookResponse])
-def read_books(
-    skip: int = 0, 
-    limit: int = 100, 
+@router.get("/", responses={200: {"model": List[BookResponse]}})
+async def read_books(
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
     title: Optional[str] = None,
     author_id: Optional[int] = None,
     category_id: Optional[int] = None,
-    db: Session = Depends(get_db)
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
 ):
-    query = db.query(Book)
+    order = [Book.book_id]
+    names = book_fields.parse(fields)
     
-    # Apply filters if provided
-    if title:
-        query = query.filter(Book.title.ilike(f"%{title}%"))
-    if author_id:
-        query = query.filter(Book.authors.any(Author.author_id == author_id))
-    if category_id:
-        query = query.filter(Book.category_id == category_id)
+    def page(query):
+        # Apply filters if provided
+        query = filter_books(query, title, author_id, category_id)
+        return paginate(query, order, cursor, skip, limit)
+    
+    async def load_books():
+        rows = (await db.execute(page(book_fields.select(names, order)))).all()
+        set_next_cursor(response, rows, order, limit)
+        return await book_fields.build(db, rows, names)
+    
+    return await conditional_get(
+        request, response, list_key(request),
+        lambda: page_version(db, page(book_version_query())), load_books
+    )
+
+
+@router.get("/export")
+async def export_books(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    title: Optional[str] = None,
+    author_id: Optional[int] = None,
+    category_id: Optional[int] = None
+):
+    """Stream every matching book as NDJSON or CSV, in a layout /books/import accepts"""
+    # group_concat separates with commas on both MySQL and SQLite
+    author_ids = (
+        select(func.group_concat(book_authors.c.author_id))
+        .where(book_authors.c.book_id == Book.book_id)
+        .scalar_subquery()
+        .label("author_ids")
+    )
+    query = filter_books(
+        select(
+            Book.book_id, Book.title, Book.isbn, Book.publication_year, Book.publisher,
+            Book.total_copies, Book.available_copies, Book.category_id,
+            Book.created_at, Book.updated_at, author_ids
+        ),
+        title, author_id, category_id
+    ).order_by(Book.book_id)
+    
+    def convert(row):
+        *values, ids = row
+        return [*values, [int(i) for i in ids.split(",")] if ids else []]
     
-    books = query.offset(skip).limit(limit).all()
-    return books
+    return export_response(query, format, "books", convert)
+
+
+@router.get("/search", response_model=List[BookResponse])
+async def search_books(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1),
+    db: AsyncSession = Depends(get_db)
+):
+    """Books matching words from the title, author names or publisher, best match first"""
+    book_ids = await search_book_ids(db, q, page_limit(limit))
+    if not book_ids:
+        return []
+    books = await db.scalars(book_query().filter(Book.book_id.in_(book_ids)))
+    by_id = {book.book_id: book for book in books}
+    return [by_id[book_id] for book_id in book_ids if book_id in by_id]
 
 
 @router.get("/{book_id}", response_model=BookResponse)
-def read_book(book_id: int, db: Session = Depends(get_db)):
-    db_book = db.query(Book).filter(Book.book_id == book_id).first()
-    if db_book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
-    return db_book
+async def read_book(book_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    async def load_book():
+        return jsonable_encoder(BookResponse.from_orm(await get_book_or_404(db, book_id)))
+    
+    return await conditional_get(
+        request, response, detail_key(request),
+        lambda: row_version(db, book_version(book_id), "Book not found"), load_book,
+        cache_key=entity_key("book", book_id)
+    )
 
 
 @router.put("/{book_id}", response_model=BookResponse)
-def update_book(book_id: int, book: BookUpdate, db: Session = Depends(get_db)):
-    db_book = db.query(Book).filter(Book.book_id == book_id).first()
-    if db_book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
+async def update_book(
+    book_id: int,
+    book: BookUpdate,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    await check_if_match(request, lambda: row_version(db, book_version(book_id).with_for_update()))
+    # Locked before it is read, like everything else that serves the book's line
+    await lock_books(db, [book_id])
+    db_book = await get_book_or_404(db, book_id)
+    total_copies, shelved = db_book.total_copies, db_book.available_copies
     
     # Update book attributes
     update_data = book.dict(exclude={"author_ids"}, exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_book, key, value)
+    if "available_copies" not in update_data:
+        # Copies added to the stock go on the shelf, copies taken away come off it
+        db_book.available_copies += db_book.total_copies - total_copies
+    if not 0 <= db_book.available_copies <= db_book.total_copies:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="available_copies must be between 0 and total_copies"
+        )
+    # Copies coming onto the shelf go to the members waiting for the book first
+    added = db_book.available_copies - shelved
+    if added > 0:
+        db_book.available_copies = shelved
+        await db.flush()
+        await return_copies(db, {book_id: added})
     
     # Update authors if provided
     if book.author_ids is not None:
-        # Clear current authors
-        db_book.authors = []
-        
-        # Add new authors
-        for author_id in book.author_ids:
-            author = db.query(Author).filter(Author.author_id == author_id).first()
-            if not author:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Author with ID {author_id} not found"
-                )
-            db_book.authors.append(author)
+        # Replace current authors. The book's row does not change with them,
+        # so its version is bumped by hand.
+        db_book.authors = await get_authors_or_404(db, book.author_ids)
+        db_book.version = Book.version + 1
     
-    db.commit()
-    db.refresh(db_book)
-    return db_book
+    await index_book(db, db_book)
+    await db.commit()
+    cache.delete(entity_key("book", book_id))
+    await set_etag(request, response, lambda: row_version(db, book_version(book_id)))
+    return await get_book_or_404(db, book_id, reload=True)
 
 
 @router.delete("/{book_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_book(book_id: int, db: Session = Depends(get_db)):
-    db_book = db.query(Book).filter(Book.book_id == book_id).first()
-    if db_book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
+async def delete_book(book_id: int, db: AsyncSession = Depends(get_db)):
+    db_book = await get_book_or_404(db, book_id)
     
-    db.delete(db_book)
-    db.commit()
+    await unindex_book(db, book_id)
+    await db.delete(db_book)
+    await db.commit()
+    cache.delete(entity_key("book", book_id))
     return None
\ No newline at end of file
@@ -1,10 +1,18 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, Query
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import get_db
+from app.cache import CATEGORY_LIST_PREFIX, book_keys, cache, entity_key
+from app.conditional import check_if_match, conditional_get, detail_key, list_key, page_version, row_version, set_etag
+from app.fieldsets import category_fields
+from app.pagination import paginate, set_next_cursor
+from app.models.book import Book
 from app.models.category import Category
 from app.schemas.category import CategoryCreate, CategoryUpdate, CategoryResponse
+from app.versions import category_version_query
 
 router = APIRouter(
     prefix="/categories",
@@ -13,35 +21,87 @@ router = APIRouter(
 )
 
 
+def category_version(category_id: int):
+    return category_version_query().filter(Category.category_id == category_id)
+
+
+async def category_book_ids(db: AsyncSession, category_id: int):
+    result = await db.scalars(select(Book.book_id).filter(Book.category_id == category_id))
+    return result.all()
+
+
+def invalidate_category(category_id: int, book_ids):
+    """Drop a category, the list pages and the books embedding it from the cache"""
+    cache.delete(entity_key("category", category_id), *book_keys(book_ids))
+    cache.delete_prefix(CATEGORY_LIST_PREFIX)
+
+
 @router.post("/", response_model=CategoryResponse, status_code=status.HTTP_201_CREATED)
-def create_category(category: CategoryCreate, db: Session = Depends(get_db)):
+async def create_category(category: CategoryCreate, db: AsyncSession = Depends(get_db)):
     db_category = Category(
         name=category.name,
         description=category.description
     )
     db.add(db_category)
-    db.commit()
-    db.refresh(db_category)
+    await db.commit()
+    cache.delete_prefix(CATEGORY_LIST_PREFIX)
+    await db.refresh(db_category)
     return db_category
 
 
-@router.get("/", response_model=List[CategoryResponse])
-def read_categories(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    categories = db.query(Category).offset(skip).limit(limit).all()
-    return categories
+@router.get("/", responses={200: {"model": List[CategoryResponse]}})
+async def read_categories(
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    order = [Category.category_id]
+    names = category_fields.parse(fields)
+    
+    async def load_categories():
+        query = category_fields.select(names, order)
+        rows = (await db.execute(paginate(query, order, cursor, skip, limit))).all()
+        set_next_cursor(response, rows, order, limit)
+        return jsonable_encoder(await category_fields.build(db, rows, names))
+    
+    # Pages are cached together with the cursor of the page after them
+    return await conditional_get(
+        request, response, list_key(request),
+        lambda: page_version(db, paginate(category_version_query(), order, cursor, skip, limit)),
+        load_categories,
+        cache_key=f"{CATEGORY_LIST_PREFIX}{skip}:{limit}:{cursor}:{fields}"
+    )
 
 
 @router.get("/{category_id}", response_model=CategoryResponse)
-def read_category(category_id: int, db: Session = Depends(get_db)):
-    db_category = db.query(Category).filter(Category.category_id == category_id).first()
-    if db_category is None:
-        raise HTTPException(status_code=404, detail="Category not found")
-    return db_category
+async def read_category(category_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    async def load_category():
+        db_category = await db.get(Category, category_id)
+        if db_category is None:
+            raise HTTPException(status_code=404, detail="Category not found")
+        return jsonable_encoder(CategoryResponse.from_orm(db_category))
+    
+    return await conditional_get(
+        request, response, detail_key(request),
+        lambda: row_version(db, category_version(category_id), "Category not found"), load_category,
+        cache_key=entity_key("category", category_id)
+    )
 
 
 @router.put("/{category_id}", response_model=CategoryResponse)
-def update_category(category_id: int, category: CategoryUpdate, db: Session = Depends(get_db)):
-    db_category = db.query(Category).filter(Category.category_id == category_id).first()
+async def update_category(
+    category_id: int,
+    category: CategoryUpdate,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    await check_if_match(request, lambda: row_version(db, category_version(category_id).with_for_update()))
+    db_category = await db.get(Category, category_id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     
@@ -49,17 +109,22 @@ def update_category(category_id: int, category: CategoryUpdate, db: Session = De
     for key, value in update_data.items():
         setattr(db_category, key, value)
     
-    db.commit()
-    db.refresh(db_category)
+    book_ids = await category_book_ids(db, category_id)
+    await db.commit()
+    invalidate_category(category_id, book_ids)
+    await db.refresh(db_category)
+    await set_etag(request, response, lambda: row_version(db, category_version(category_id)))
     return db_category
 
 
 @router.delete("/{category_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_category(category_id: int, db: Session = Depends(get_db)):
-    db_category = db.query(Category).filter(Category.category_id == category_id).first()
+async def delete_category(category_id: int, db: AsyncSession = Depends(get_db)):
+    db_category = await db.get(Category, category_id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     
-    db.delete(db_category)
-    db.commit()
+    book_ids = await category_book_ids(db, category_id)
+    await db.delete(db_category)
+    await db.commit()
+    invalidate_category(category_id, book_ids)
     return None
\ No newline at end of file
@@ -1,14 +1,32 @@
+from collections import Counter
 from typing import List, Optional
-from datetime import date, timedelta
-from decimal import Decimal
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session, joinedload
+from datetime import date
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status, Query
+from sqlalchemy import case, delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
+from app.accounts import AccountChanges, take_loans
+from app.availability import reserve_copies
+from app.config import settings
 from app.database import get_db
+from app.cache import book_keys, cache
+from app.conditional import check_if_match, conditional_get, detail_key, list_key, page_version, row_version, set_etag
+from app.export import export_response
+from app.fieldsets import expand_paths, loan_fields
+from app.fines import calculate_fine
+from app.idempotency import idempotency
+from app.pagination import paginate, set_next_cursor
+from app.reservations import open_reservations, return_copies
 from app.models.loan import Loan
 from app.models.book import Book
 from app.models.member import Member
-from app.schemas.loan import LoanCreate, LoanUpdate, LoanResponse
+from app.stats import record_checkouts, record_deleted_loan, record_returns
+from app.schemas.loan import (
+    LoanCreate, LoanUpdate, LoanResponse,
+    LoanBulkCreate, LoanBulkReturn, LoanBulkItem, LoanBulkResult
+)
+from app.versions import loan_version_query
 
 router = APIRouter(
     prefix="/loans",
@@ -16,33 +34,111 @@ router = APIRouter(
     responses={404: {"description": "Loan not found"}}
 )
 
+def loan_query():
+    """Select loans with everything LoanResponse needs loaded up front"""
+    return select(Loan).options(
+        joinedload(Loan.book).joinedload(Book.category),
+        joinedload(Loan.book).selectinload(Book.authors),
+        joinedload(Loan.member)
+    )
+
+
+async def get_loan_or_404(db: AsyncSession, loan_id: int, reload: bool = False):
+    query = loan_query().filter(Loan.loan_id == loan_id)
+    if reload:
+        query = query.execution_options(populate_existing=True)
+    db_loan = await db.scalar(query)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    return db_loan
+
+
+def filter_loans(query, member_id: Optional[int], book_id: Optional[int], status: Optional[str]):
+    if member_id:
+        query = query.filter(Loan.member_id == member_id)
+    if book_id:
+        query = query.filter(Loan.book_id == book_id)
+    if status:
+        query = query.filter(Loan.status == status)
+    return query
+
+
+def loan_version(loan_id: int):
+    return loan_version_query().filter(Loan.loan_id == loan_id)
+
+
+async def get_active_member_or_error(db: AsyncSession, member_id: int):
+    member = await db.get(Member, member_id)
+    if not member:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Member not found"
+        )
+    if member.membership_status != 'active':
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Member's status is {member.membership_status}, not active"
+        )
+    return member
+
+
+async def mark_returned(db: AsyncSession, fines, return_date: date):
+    """Mark loans returned with the given fines, unless already returned
+
+    Returns how many loans changed, which is fewer than len(fines) when a
+    concurrent request returned some of them first.
+    """
+    result = await db.execute(
+        update(Loan)
+        .where(Loan.loan_id.in_(list(fines)), Loan.status != 'returned')
+        .values(
+            status='returned',
+            return_date=return_date,
+            fine_amount=case(fines, value=Loan.loan_id)
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
 
 @router.post("/", response_model=LoanResponse, status_code=status.HTTP_201_CREATED)
-def create_loan(loan: LoanCreate, db: Session = Depends(get_db)):
-    # Check if book exists and is available
-    book = db.query(Book).filter(Book.book_id == loan.book_id).first()
+async def create_loan(
+    loan: LoanCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Check out a book. A retry with the same Idempotency-Key gets the first response back."""
+    return await idempotency.run(
+        idempotency_key and f"loans:{idempotency_key}", loan, response,
+        lambda: add_loan(db, loan), LoanResponse
+    )
+
+
+async def add_loan(db, loan):
+    # Check if book exists and take a copy, provided one is still available.
+    # A member collecting their hold takes the copy put aside for them instead.
+    # Nothing is committed if the member checks below fail. The book is locked
+    # before the hold, like everything else that touches the book's line.
+    book = await db.get(Book, loan.book_id, with_for_update=True)
     if not book:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Book not found"
         )
-    if book.available_copies <= 0:
+    hold = (await open_reservations(db, loan.member_id, [loan.book_id])).get(loan.book_id)
+    if (hold is None or hold.status != 'ready') and not await reserve_copies(db, {loan.book_id: 1}):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Book is not available for loan"
         )
     
-    # Check if member exists and is active
-    member = db.query(Member).filter(Member.member_id == loan.member_id).first()
-    if not member:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Member not found"
-        )
-    if member.membership_status != 'active':
+    # Check if member exists and is active, and count the loan against their limit
+    await get_active_member_or_error(db, loan.member_id)
+    if not await take_loans(db, loan.member_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Member's status is {member.membership_status}, not active"
+            detail=f"Member already has the maximum of {settings.max_active_loans} active loans"
         )
     
     # Create loan
@@ -50,106 +146,286 @@ def create_loan(loan: LoanCreate, db: Session = Depends(get_db)):
         book_id=loan.book_id,
         member_id=loan.member_id,
         due_date=loan.due_date,
-        status='borrowed'
+        status='borrowed',
+        category_id=book.category_id
     )
     
-    # Update book's available copies
-    book.available_copies -= 1
-    
     db.add(db_loan)
-    db.commit()
-    db.refresh(db_loan)
-    return db_loan
+    if hold is not None:
+        hold.status = 'fulfilled'
+    await record_checkouts(db, [db_loan])
+    await db.commit()
+    cache.delete(*book_keys([loan.book_id]))
+    return await get_loan_or_404(db, db_loan.loan_id, reload=True)
+
+
+@router.post("/bulk", response_model=LoanBulkResult)
+async def create_loans_bulk(
+    loans: LoanBulkCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Check out a stack of books to one member in a single transaction"""
+    return await idempotency.run(
+        idempotency_key and f"loans/bulk:{idempotency_key}", loans, response,
+        lambda: add_loans(db, loans), LoanBulkResult
+    )
+
+
+async def add_loans(db, loans):
+    await get_active_member_or_error(db, loans.member_id)
+    
+    # Fetch and lock every requested book at once
+    result = await db.scalars(
+        select(Book).filter(Book.book_id.in_(set(loans.book_ids))).with_for_update()
+    )
+    books = {book.book_id: book for book in result}
+    # Copies on the hold shelf for the member are theirs to take
+    holds = await open_reservations(db, loans.member_id, books)
+    held = Counter(book_id for book_id, hold in holds.items() if hold.status == 'ready')
+    
+    outcomes = []
+    checked_out = Counter()
+    for book_id in loans.book_ids:
+        book = books.get(book_id)
+        if book is None:
+            outcomes.append((book_id, None, "Book not found"))
+        elif book.available_copies + held[book_id] - checked_out[book_id] <= 0:
+            outcomes.append((book_id, None, "Book is not available for loan"))
+        else:
+            checked_out[book_id] += 1
+            db_loan = Loan(
+                book_id=book_id,
+                member_id=loans.member_id,
+                due_date=loans.due_date,
+                status='borrowed',
+                category_id=book.category_id
+            )
+            db.add(db_loan)
+            outcomes.append((book_id, db_loan, None))
+    
+    count = sum(checked_out.values())
+    if count and not await take_loans(db, loans.member_id, count):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{count} more loans would take the member over the maximum of {settings.max_active_loans}"
+        )
+    
+    # The rows are locked, so this only fails on databases without row locks
+    if not await reserve_copies(db, checked_out - held):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Availability changed during checkout, please retry"
+        )
+    for book_id in checked_out:
+        if book_id in holds:
+            holds[book_id].status = 'fulfilled'
+    await record_checkouts(db, [db_loan for _, db_loan, _ in outcomes if db_loan is not None])
+    await db.commit()
+    cache.delete(*book_keys(checked_out))
+    
+    items = [
+        LoanBulkItem(book_id=book_id, loan_id=db_loan.loan_id if db_loan else None, error=error)
+        for book_id, db_loan, error in outcomes
+    ]
+    succeeded = sum(checked_out.values())
+    return LoanBulkResult(succeeded=succeeded, failed=len(items) - succeeded, items=items)
+
+
+@router.post("/bulk-return", response_model=LoanBulkResult)
+async def return_books_bulk(returns: LoanBulkReturn, db: AsyncSession = Depends(get_db)):
+    """Return a stack of loans in a single transaction"""
+    result = await db.scalars(
+        select(Loan).filter(Loan.loan_id.in_(set(returns.loan_ids))).with_for_update()
+    )
+    db_loans = {db_loan.loan_id: db_loan for db_loan in result}
+    
+    return_date = date.today()
+    items = []
+    returned = {}
+    returned_copies = Counter()
+    accounts = AccountChanges()
+    for loan_id in returns.loan_ids:
+        db_loan = db_loans.get(loan_id)
+        if db_loan is None:
+            items.append(LoanBulkItem(loan_id=loan_id, error="Loan not found"))
+        elif db_loan.status == 'returned' or loan_id in returned:
+            items.append(LoanBulkItem(loan_id=loan_id, book_id=db_loan.book_id, error="Book has already been returned"))
+        else:
+            fine = calculate_fine(db_loan.due_date, return_date)
+            returned[loan_id] = fine if fine is not None else db_loan.fine_amount
+            returned_copies[db_loan.book_id] += 1
+            accounts.add(db_loan.member_id, (db_loan.status, db_loan.fine_amount), ('returned', returned[loan_id]))
+            items.append(LoanBulkItem(loan_id=loan_id, book_id=db_loan.book_id, fine_amount=returned[loan_id]))
+    
+    if returned:
+        if await mark_returned(db, returned, return_date) != len(returned):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Some loans were returned concurrently, please retry"
+            )
+        await return_copies(db, returned_copies)
+        await accounts.apply(db)
+        await record_returns(db, returned_copies, return_date)
+    await db.commit()
+    cache.delete(*book_keys(returned_copies))
+    
+    return LoanBulkResult(succeeded=len(returned), failed=len(items) - len(returned), items=items)
 
 
-@router.get("/", response_model=List[LoanResponse])
-def read_loans(
-    skip: int = 0, 
-    limit: int = 100,
+@router.get("/", responses={200: {"model": List[LoanResponse]}})
+async def read_loans(
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
     member_id: Optional[int] = None,
     book_id: Optional[int] = None,
     status: Optional[str] = None,
-    db: Session = Depends(get_db)
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
 ):
-    query = db.query(Loan)
+    # Loans page in due date order, with the id breaking ties
+    order = [Loan.due_date, Loan.loan_id]
+    tree = loan_fields.parse_expand(expand)
+    names = loan_fields.parse(fields, tree)
     
-    # Apply filters if provided
-    if member_id:
-        query = query.filter(Loan.member_id == member_id)
-    if book_id:
-        query = query.filter(Loan.book_id == book_id)
-    if status:
-        query = query.filter(Loan.status == status)
+    def page(query):
+        # Apply filters if provided
+        query = filter_loans(query, member_id, book_id, status)
+        return paginate(query, order, cursor, skip, limit)
     
-    loans = query.options(
-        joinedload(Loan.book),
-        joinedload(Loan.member)
-    ).offset(skip).limit(limit).all()
+    async def load_loans():
+        rows = (await db.execute(page(loan_fields.select(names, order)))).all()
+        set_next_cursor(response, rows, order, limit)
+        return await loan_fields.build(db, rows, names, tree)
     
-    return loans
+    return await conditional_get(
+        request, response, list_key(request),
+        lambda: page_version(db, page(loan_version_query())), load_loans
+    )
 
 
-@router.get("/{loan_id}", response_model=LoanResponse)
-def read_loan(loan_id: int, db: Session = Depends(get_db)):
-    db_loan = db.query(Loan).filter(Loan.loan_id == loan_id).first()
-    if db_loan is None:
-        raise HTTPException(status_code=404, detail="Loan not found")
-    return db_loan
+@router.get("/export")
+async def export_loans(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    member_id: Optional[int] = None,
+    book_id: Optional[int] = None,
+    status: Optional[str] = None
+):
+    """Stream every matching loan as NDJSON or CSV, with ids in place of the embedded book and member"""
+    query = filter_loans(select(*Loan.__table__.columns), member_id, book_id, status)
+    return export_response(query.order_by(Loan.loan_id), format, "loans")
+
+
+@router.get("/{loan_id}", responses={200: {"model": LoanResponse}})
+async def read_loan(
+    loan_id: int,
+    request: Request,
+    response: Response,
+    expand: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    tree = loan_fields.parse_expand(expand)
+    names = loan_fields.parse(expand=tree)
+    
+    async def load_loan():
+        loans = await loan_fields.load_by(db, Loan.loan_id, [loan_id], names, tree)
+        if loan_id not in loans:
+            raise HTTPException(status_code=404, detail="Loan not found")
+        return loans[loan_id]
+    
+    return await conditional_get(
+        request, response, detail_key(request),
+        lambda: row_version(db, loan_version(loan_id), "Loan not found"), load_loan,
+        variant=expand_paths(tree)
+    )
 
 
 @router.put("/{loan_id}", response_model=LoanResponse)
-def update_loan(loan_id: int, loan: LoanUpdate, db: Session = Depends(get_db)):
-    db_loan = db.query(Loan).filter(Loan.loan_id == loan_id).first()
+async def update_loan(
+    loan_id: int,
+    loan: LoanUpdate,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    await check_if_match(request, lambda: row_version(db, loan_version(loan_id).with_for_update()))
+    db_loan = await db.get(Loan, loan_id, with_for_update=True)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
     
     update_data = loan.dict(exclude_unset=True)
+    # A returned loan's copy is back on the shelf, or with the next member in
+    # line, so it cannot be reopened; the book is checked out again instead
+    if db_loan.status == 'returned' and update_data.get('status', 'returned') != 'returned':
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Book has already been returned, check it out again instead"
+        )
+    before = (db_loan.status, db_loan.fine_amount)
     
     # If returning a book, update book availability
+    returned = False
     if update_data.get('status') == 'returned' and db_loan.status != 'returned':
-        # Mark as returned
-        db_loan.return_date = date.today() if not update_data.get('return_date') else update_data['return_date']
-        
-        # Update book's available copies
-        book = db.query(Book).filter(Book.book_id == db_loan.book_id).first()
-        if book:
-            book.available_copies += 1
+        return_date = date.today() if not update_data.get('return_date') else update_data['return_date']
         
         # Calculate fine if returned late
-        if db_loan.due_date < db_loan.return_date:
-            days_late = (db_loan.return_date - db_loan.due_date).days
-            fine_per_day = Decimal('0.50')  # $0.50 per day
-            db_loan.fine_amount = days_late * fine_per_day
+        fine = calculate_fine(db_loan.due_date, return_date)
+        if fine is None:
+            fine = db_loan.fine_amount
+        
+        # Mark as returned and pass the copy on to the next member in line, or
+        # put it back on the shelf, unless a concurrent request returned it first
+        if await mark_returned(db, {loan_id: fine}, return_date):
+            await return_copies(db, {db_loan.book_id: 1})
+            returned = True
+        await db.refresh(db_loan)
     
     for key, value in update_data.items():
         setattr(db_loan, key, value)
+    await AccountChanges().add(db_loan.member_id, before, (db_loan.status, db_loan.fine_amount)).apply(db)
+    if returned:
+        await record_returns(db, Counter([db_loan.book_id]), return_date)
     
-    db.commit()
-    db.refresh(db_loan)
-    return db_loan
+    await db.commit()
+    cache.delete(*book_keys([db_loan.book_id]))
+    await set_etag(request, response, lambda: row_version(db, loan_version(loan_id)))
+    return await get_loan_or_404(db, loan_id, reload=True)
 
 
 @router.delete("/{loan_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_loan(loan_id: int, db: Session = Depends(get_db)):
-    db_loan = db.query(Loan).filter(Loan.loan_id == loan_id).first()
+async def delete_loan(loan_id: int, db: AsyncSession = Depends(get_db)):
+    db_loan = await db.get(Loan, loan_id, with_for_update=True)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
     
-    # If the loan is borrowed, increase the book's available copies when deleted
-    if db_loan.status == 'borrowed':
-        book = db.query(Book).filter(Book.book_id == db_loan.book_id).first()
-        if book:
-            book.available_copies += 1
-    
-    db.delete(db_loan)
-    db.commit()
+    # If the book is still out (borrowed or overdue), its copy comes back when
+    # the loan is deleted. The DELETE checks the status itself, so a
+    # concurrent return cannot give the same copy back twice.
+    result = await db.execute(
+        delete(Loan)
+        .where(Loan.loan_id == loan_id, Loan.status != 'returned')
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount:
+        await return_copies(db, {db_loan.book_id: 1})
+    else:
+        await db.delete(db_loan)
+    await AccountChanges().add(db_loan.member_id, before=(db_loan.status, db_loan.fine_amount)).apply(db)
+    await record_deleted_loan(db, db_loan)
+    await db.commit()
+    cache.delete(*book_keys([db_loan.book_id]))
     return None
 
 
 @router.post("/{loan_id}/return", response_model=LoanResponse)
-def return_book(loan_id: int, db: Session = Depends(get_db)):
+async def return_book(loan_id: int, db: AsyncSession = Depends(get_db)):
     """Convenience endpoint to return a book"""
-    db_loan = db.query(Loan).filter(Loan.loan_id == loan_id).first()
+    db_loan = await db.get(Loan, loan_id, with_for_update=True)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
     
@@ -160,20 +436,24 @@ def return_book(loan_id: int, db: Session = Depends(get_db)):
         )
     
     return_date = date.today()
-    db_loan.return_date = return_date
-    db_loan.status = 'returned'
-    
-    # Update book's available copies
-    book = db.query(Book).filter(Book.book_id == db_loan.book_id).first()
-    if book:
-        book.available_copies += 1
     
     # Calculate fine if returned late
-    if db_loan.due_date < return_date:
-        days_late = (return_date - db_loan.due_date).days
-        fine_per_day = Decimal('0.50')  # $0.50 per day
-        db_loan.fine_amount = days_late * fine_per_day
-    
-    db.commit()
-    db.refresh(db_loan)
-    return db_loan
\ No newline at end of file
+    fine = calculate_fine(db_loan.due_date, return_date)
+    if fine is None:
+        fine = db_loan.fine_amount
+    
+    # Mark as returned, unless a concurrent request got there first
+    if not await mark_returned(db, {loan_id: fine}, return_date):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Book has already been returned"
+        )
+    
+    # Hand the copy to the next member in line, or put it back on the shelf
+    await return_copies(db, {db_loan.book_id: 1})
+    await AccountChanges().add(db_loan.member_id, (db_loan.status, db_loan.fine_amount), ('returned', fine)).apply(db)
+    await record_returns(db, Counter([db_loan.book_id]), return_date)
+    
+    await db.commit()
+    cache.delete(*book_keys([db_loan.book_id]))
+    return await get_loan_or_404(db, loan_id, reload=True)
\ No newline at end of file
@@ -1,10 +1,21 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status, Query
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import get_db
+from app.bulk_import import insert_members, read_records, run_import
+from app.config import settings
+from app.cache import cache, entity_key
+from app.conditional import check_if_match, conditional_get, detail_key, list_key, page_version, row_version, set_etag
+from app.fieldsets import member_fields
+from app.idempotency import idempotency
+from app.pagination import paginate, set_next_cursor
 from app.models.member import Member
-from app.schemas.member import MemberCreate, MemberUpdate, MemberResponse
+from app.schemas.bulk import ImportReport
+from app.schemas.member import MemberCreate, MemberUpdate, MemberResponse, MemberSummary
+from app.versions import member_version_query
 
 router = APIRouter(
     prefix="/members",
@@ -13,10 +24,38 @@ router = APIRouter(
 )
 
 
+def filter_members(query, name: Optional[str], status: Optional[str]):
+    if name:
+        query = query.filter(
+            (Member.first_name.ilike(f"%{name}%")) | 
+            (Member.last_name.ilike(f"%{name}%"))
+        )
+    if status:
+        query = query.filter(Member.membership_status == status)
+    return query
+
+
+def member_version(member_id: int):
+    return member_version_query().filter(Member.member_id == member_id)
+
+
 @router.post("/", response_model=MemberResponse, status_code=status.HTTP_201_CREATED)
-def create_member(member: MemberCreate, db: Session = Depends(get_db)):
+async def create_member(
+    member: MemberCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Register a member. A retry with the same Idempotency-Key gets the first response back."""
+    return await idempotency.run(
+        idempotency_key and f"members:{idempotency_key}", member, response,
+        lambda: add_member(db, member), MemberResponse
+    )
+
+
+async def add_member(db, member):
     # Check if member with email already exists
-    existing_member = db.query(Member).filter(Member.email == member.email).first()
+    existing_member = await db.scalar(select(Member).filter(Member.email == member.email))
     if existing_member:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -31,51 +70,98 @@ def create_member(member: MemberCreate, db: Session = Depends(get_db)):
         address=member.address
     )
     db.add(db_member)
-    db.commit()
-    db.refresh(db_member)
+    await db.commit()
+    await db.refresh(db_member)
     return db_member
 
 
-@router.get("/", response_model=List[MemberResponse])
-def read_members(
-    skip: int = 0, 
-    limit: int = 100,
+@router.post("/import", response_model=ImportReport)
+async def import_members(request: Request, db: AsyncSession = Depends(get_db)):
+    """Bulk import members from a streamed NDJSON body, or CSV when sent as text/csv"""
+    return await run_import(db, read_records(request), MemberCreate, insert_members)
+
+
+@router.get("/", responses={200: {"model": List[MemberResponse]}})
+async def read_members(
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
     name: Optional[str] = None,
     status: Optional[str] = None,
-    db: Session = Depends(get_db)
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
 ):
-    query = db.query(Member)
+    order = [Member.member_id]
+    names = member_fields.parse(fields)
     
-    # Apply filters if provided
-    if name:
-        query = query.filter(
-            (Member.first_name.ilike(f"%{name}%")) | 
-            (Member.last_name.ilike(f"%{name}%"))
-        )
-    if status:
-        query = query.filter(Member.membership_status == status)
+    def page(query):
+        # Apply filters if provided
+        query = filter_members(query, name, status)
+        return paginate(query, order, cursor, skip, limit)
     
-    members = query.offset(skip).limit(limit).all()
-    return members
+    async def load_members():
+        rows = (await db.execute(page(member_fields.select(names, order)))).all()
+        set_next_cursor(response, rows, order, limit)
+        return await member_fields.build(db, rows, names)
+    
+    return await conditional_get(
+        request, response, list_key(request),
+        lambda: page_version(db, page(member_version_query())), load_members
+    )
 
 
 @router.get("/{member_id}", response_model=MemberResponse)
-def read_member(member_id: int, db: Session = Depends(get_db)):
-    db_member = db.query(Member).filter(Member.member_id == member_id).first()
-    if db_member is None:
+async def read_member(member_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    async def load_member():
+        db_member = await db.get(Member, member_id)
+        if db_member is None:
+            raise HTTPException(status_code=404, detail="Member not found")
+        return jsonable_encoder(MemberResponse.from_orm(db_member))
+    
+    return await conditional_get(
+        request, response, detail_key(request),
+        lambda: row_version(db, member_version(member_id), "Member not found"), load_member,
+        cache_key=entity_key("member", member_id)
+    )
+
+
+@router.get("/{member_id}/summary", response_model=MemberSummary)
+async def read_member_summary(member_id: int, db: AsyncSession = Depends(get_db)):
+    """Loans out, overdue loans and fines of a member, read from the account counters"""
+    row = (await db.execute(
+        select(
+            Member.member_id, Member.membership_status,
+            Member.active_loans, Member.overdue_loans, Member.outstanding_fines
+        ).filter(Member.member_id == member_id)
+    )).first()
+    if row is None:
         raise HTTPException(status_code=404, detail="Member not found")
-    return db_member
+    limit = settings.max_active_loans or None
+    return MemberSummary(
+        **row._mapping,
+        max_active_loans=limit,
+        can_borrow=row.membership_status == 'active' and (limit is None or row.active_loans < limit)
+    )
 
 
 @router.put("/{member_id}", response_model=MemberResponse)
-def update_member(member_id: int, member: MemberUpdate, db: Session = Depends(get_db)):
-    db_member = db.query(Member).filter(Member.member_id == member_id).first()
+async def update_member(
+    member_id: int,
+    member: MemberUpdate,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    await check_if_match(request, lambda: row_version(db, member_version(member_id).with_for_update()))
+    db_member = await db.get(Member, member_id)
     if db_member is None:
         raise HTTPException(status_code=404, detail="Member not found")
     
     # Check if updating email to one that already exists
     if member.email and member.email != db_member.email:
-        existing_member = db.query(Member).filter(Member.email == member.email).first()
+        existing_member = await db.scalar(select(Member).filter(Member.email == member.email))
         if existing_member:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -86,17 +172,20 @@ def update_member(member_id: int, member: MemberUpdate, db: Session = Depends(ge
     for key, value in update_data.items():
         setattr(db_member, key, value)
     
-    db.commit()
-    db.refresh(db_member)
+    await db.commit()
+    cache.delete(entity_key("member", member_id))
+    await db.refresh(db_member)
+    await set_etag(request, response, lambda: row_version(db, member_version(member_id)))
     return db_member
 
 
 @router.delete("/{member_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_member(member_id: int, db: Session = Depends(get_db)):
-    db_member = db.query(Member).filter(Member.member_id == member_id).first()
+async def delete_member(member_id: int, db: AsyncSession = Depends(get_db)):
+    db_member = await db.get(Member, member_id)
     if db_member is None:
         raise HTTPException(status_code=404, detail="Member not found")
     
-    db.delete(db_member)
-    db.commit()
+    await db.delete(db_member)
+    await db.commit()
+    cache.delete(entity_key("member", member_id))
     return None
\ No newline at end of file
@@ -0,0 +1,136 @@
+from collections import Counter
+from datetime import date
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Response, status, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.availability import reserve_copies
+from app.cache import book_keys, cache
+from app.database import get_db
+from app.models.book import Book
+from app.models.loan import Loan
+from app.models.reservation import Reservation
+from app.pagination import paginate, set_next_cursor
+from app.reservations import OPEN, lock_books, open_reservations, pickup_deadline, reservation_query, return_copies
+from app.routes.loans import get_active_member_or_error
+from app.schemas.reservation import ReservationCreate, ReservationResponse
+
+router = APIRouter(
+    prefix="/reservations",
+    tags=["reservations"],
+    responses={404: {"description": "Reservation not found"}}
+)
+
+
+async def get_reservation_or_404(db: AsyncSession, reservation_id: int):
+    row = (await db.execute(
+        reservation_query().where(Reservation.reservation_id == reservation_id)
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return row
+
+
+def filter_reservations(query, member_id: Optional[int], book_id: Optional[int], status: Optional[str]):
+    if member_id:
+        query = query.filter(Reservation.member_id == member_id)
+    if book_id:
+        query = query.filter(Reservation.book_id == book_id)
+    if status == "open":
+        query = query.filter(Reservation.status.in_(OPEN))
+    elif status:
+        query = query.filter(Reservation.status == status)
+    return query
+
+
+@router.post("/", response_model=ReservationResponse, status_code=status.HTTP_201_CREATED)
+async def create_reservation(reservation: ReservationCreate, db: AsyncSession = Depends(get_db)):
+    """Join the line for a book. When a copy is on the shelf, it is put aside for the member straight away."""
+    if await db.get(Book, reservation.book_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Book not found"
+        )
+    await get_active_member_or_error(db, reservation.member_id)
+    
+    await lock_books(db, [reservation.book_id])
+    if await open_reservations(db, reservation.member_id, [reservation.book_id]):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Member already has a reservation for this book"
+        )
+    # Checkouts lock the book too, so a loan cannot start between this check and the commit
+    on_loan = await db.scalar(
+        select(Loan.loan_id)
+        .where(Loan.member_id == reservation.member_id, Loan.book_id == reservation.book_id,
+               Loan.status != 'returned')
+        .limit(1)
+    )
+    if on_loan is not None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Member already has this book on loan"
+        )
+    
+    db_reservation = Reservation(book_id=reservation.book_id, member_id=reservation.member_id, status='active')
+    if await reserve_copies(db, {reservation.book_id: 1}):
+        today = date.today()
+        db_reservation.status = 'ready'
+        db_reservation.ready_date = today
+        db_reservation.expiry_date = pickup_deadline(today)
+    db.add(db_reservation)
+    await db.commit()
+    if db_reservation.status == 'ready':
+        cache.delete(*book_keys([reservation.book_id]))
+    return await get_reservation_or_404(db, db_reservation.reservation_id)
+
+
+@router.get("/", response_model=List[ReservationResponse])
+async def read_reservations(
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
+    member_id: Optional[int] = None,
+    book_id: Optional[int] = None,
+    status: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """Reservations in the order they were placed, with their place in line.
+    status=open lists those active or ready to collect."""
+    order = [Reservation.reservation_id]
+    query = filter_reservations(reservation_query(), member_id, book_id, status)
+    rows = (await db.execute(paginate(query, order, cursor, skip, limit))).all()
+    set_next_cursor(response, rows, order, limit)
+    return rows
+
+
+@router.get("/{reservation_id}", response_model=ReservationResponse)
+async def read_reservation(reservation_id: int, db: AsyncSession = Depends(get_db)):
+    return await get_reservation_or_404(db, reservation_id)
+
+
+@router.post("/{reservation_id}/cancel", response_model=ReservationResponse)
+async def cancel_reservation(reservation_id: int, db: AsyncSession = Depends(get_db)):
+    """Leave the line. A copy put aside for the member goes to the next one in line."""
+    db_reservation = await db.get(Reservation, reservation_id)
+    if db_reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    
+    await lock_books(db, [db_reservation.book_id])
+    await db.refresh(db_reservation)
+    if db_reservation.status not in OPEN:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Reservation is already {db_reservation.status}"
+        )
+    held = db_reservation.status == 'ready'
+    db_reservation.status = 'cancelled'
+    if held:
+        await db.flush()
+        await return_copies(db, Counter([db_reservation.book_id]))
+    await db.commit()
+    if held:
+        cache.delete(*book_keys([db_reservation.book_id]))
+    return await get_reservation_or_404(db, reservation_id)
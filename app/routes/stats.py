@@ -0,0 +1,96 @@
+from datetime import date, timedelta
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import get_db
+from app.models.book import Book
+from app.models.category import Category
+from app.models.stats import BookLoanStats, CategoryDailyLoans, DailyCirculation
+from app.schemas.stats import BookLoanCount, CategoryLoanCount, DailyLoanCount
+
+router = APIRouter(
+    prefix="/stats",
+    tags=["stats"],
+)
+
+# Period covered when no start date is given, and the longest one allowed
+DEFAULT_DAYS = 30
+MAX_DAYS = 3660
+
+
+def period(start: Optional[date], end: Optional[date]):
+    """Inclusive date range, the last DEFAULT_DAYS days up to end by default"""
+    end = end or date.today()
+    start = start or end - timedelta(days=DEFAULT_DAYS - 1)
+    if start > end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="start must not be after end"
+        )
+    if (end - start).days >= MAX_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Period is longer than {MAX_DAYS} days"
+        )
+    return start, end
+
+
+@router.get("/most-borrowed", response_model=List[BookLoanCount])
+async def most_borrowed_books(
+    limit: int = Query(10, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
+):
+    """Books with the most loans ever made"""
+    rows = await db.execute(
+        select(Book.book_id, Book.title, BookLoanStats.loans, BookLoanStats.active_loans)
+        .join(Book, Book.book_id == BookLoanStats.book_id)
+        .where(BookLoanStats.loans > 0)
+        .order_by(BookLoanStats.loans.desc(), BookLoanStats.book_id)
+        .limit(limit)
+    )
+    return [BookLoanCount(**row._mapping) for row in rows]
+
+
+@router.get("/busiest-categories", response_model=List[CategoryLoanCount])
+async def busiest_categories(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(10, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
+):
+    """Categories with the most loans made between start and end"""
+    start, end = period(start, end)
+    loans = func.sum(CategoryDailyLoans.loans).label("loans")
+    rows = await db.execute(
+        select(Category.category_id, Category.name, loans)
+        .join(Category, Category.category_id == CategoryDailyLoans.category_id)
+        .where(CategoryDailyLoans.day.between(start, end))
+        .group_by(Category.category_id, Category.name)
+        .having(loans > 0)
+        .order_by(loans.desc(), Category.category_id)
+        .limit(limit)
+    )
+    return [CategoryLoanCount(**row._mapping) for row in rows]
+
+
+@router.get("/loans-per-day", response_model=List[DailyLoanCount])
+async def loans_per_day(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """Loans made and returned on each day between start and end, quiet days included"""
+    start, end = period(start, end)
+    rows = await db.execute(
+        select(DailyCirculation.day, DailyCirculation.loans, DailyCirculation.returns)
+        .where(DailyCirculation.day.between(start, end))
+    )
+    counts = {row.day: row for row in rows}
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        row = counts.get(day)
+        days.append(DailyLoanCount(day=day, loans=row.loans if row else 0, returns=row.returns if row else 0))
+    return days
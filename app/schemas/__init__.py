@@ -3,4 +3,8 @@ from app.schemas.author import AuthorBase, AuthorCreate, AuthorUpdate, AuthorRes
 from app.schemas.book import BookBase, BookCreate, BookUpdate, BookResponse
 from app.schemas.category import CategoryBase, CategoryCreate, CategoryUpdate, CategoryResponse
 from app.schemas.member import MemberBase, MemberCreate, MemberUpdate, MemberResponse
-from app.schemas.loan import LoanBase, LoanCreate, LoanUpdate, LoanResponse
\ No newline at end of file
+from app.schemas.loan import (
+    LoanBase, LoanCreate, LoanUpdate, LoanResponse,
+    LoanBulkCreate, LoanBulkReturn, LoanBulkItem, LoanBulkResult
+)
+from app.schemas.bulk import RowError, ImportReport
\ No newline at end of file
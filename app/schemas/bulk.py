@@ -0,0 +1,15 @@
+from typing import List
+from pydantic import BaseModel
+
+
+class RowError(BaseModel):
+    row: int
+    error: str
+
+
+class ImportReport(BaseModel):
+    received: int = 0
+    imported: int = 0
+    failed: int = 0
+    # Capped at MAX_REPORTED_ERRORS entries, failed holds the full count
+    errors: List[RowError] = []
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from datetime import date, datetime
 from decimal import Decimal
 from pydantic import BaseModel
@@ -33,4 +33,27 @@ class LoanResponse(LoanBase):
     member: Optional[MemberResponse] = None
     
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class LoanBulkCreate(BaseModel):
+    member_id: int
+    due_date: date
+    book_ids: List[int]
+
+
+class LoanBulkReturn(BaseModel):
+    loan_ids: List[int]
+
+
+class LoanBulkItem(BaseModel):
+    book_id: Optional[int] = None
+    loan_id: Optional[int] = None
+    fine_amount: Optional[Decimal] = None
+    error: Optional[str] = None
+
+
+class LoanBulkResult(BaseModel):
+    succeeded: int
+    failed: int
+    items: List[LoanBulkItem]
\ No newline at end of file
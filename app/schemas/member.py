@@ -1,5 +1,6 @@
 from typing import Optional
 from datetime import date
+from decimal import Decimal
 from pydantic import BaseModel, EmailStr
 
 
@@ -30,4 +31,14 @@ class MemberResponse(MemberBase):
     membership_status: str
     
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class MemberSummary(BaseModel):
+    member_id: int
+    membership_status: str
+    active_loans: int
+    overdue_loans: int
+    outstanding_fines: Decimal
+    max_active_loans: Optional[int] = None
+    can_borrow: bool
@@ -0,0 +1,21 @@
+from typing import Optional
+from datetime import date
+from pydantic import BaseModel
+
+
+class ReservationCreate(BaseModel):
+    book_id: int
+    member_id: int
+
+
+class ReservationResponse(ReservationCreate):
+    reservation_id: int
+    reservation_date: date
+    status: str
+    ready_date: Optional[date] = None
+    expiry_date: Optional[date] = None
+    # Place in line while the reservation is active, 1 being next
+    position: Optional[int] = None
+
+    class Config:
+        orm_mode = True
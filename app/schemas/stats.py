@@ -0,0 +1,21 @@
+from datetime import date
+from pydantic import BaseModel
+
+
+class BookLoanCount(BaseModel):
+    book_id: int
+    title: str
+    loans: int
+    active_loans: int
+
+
+class CategoryLoanCount(BaseModel):
+    category_id: int
+    name: str
+    loans: int
+
+
+class DailyLoanCount(BaseModel):
+    day: date
+    loans: int
+    returns: int
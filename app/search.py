@@ -0,0 +1,164 @@
+import re
+import sys
+from collections import Counter
+
+from sqlalchemy import and_, case, delete, distinct, func, insert, or_, select
+from sqlalchemy.orm import selectinload
+
+from app.models.book import Book, book_authors
+from app.models.search import BookSearchTerm
+
+# Weight of a term by the field it occurs in
+TITLE_WEIGHT = 3
+AUTHOR_WEIGHT = 2
+PUBLISHER_WEIGHT = 1
+
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text):
+    """Lower-cased word terms of at least two characters"""
+    if not text:
+        return []
+    return [
+        word[:MAX_TERM_LENGTH]
+        for word in re.findall(r"\w+", text.lower())
+        if len(word) > 1
+    ]
+
+
+def book_terms(book):
+    """Weighted terms for a book, its authors must be loaded"""
+    terms = Counter()
+    for term in tokenize(book.title):
+        terms[term] += TITLE_WEIGHT
+    for author in book.authors:
+        for term in tokenize(f"{author.first_name} {author.last_name}"):
+            terms[term] += AUTHOR_WEIGHT
+    for term in tokenize(book.publisher):
+        terms[term] += PUBLISHER_WEIGHT
+    return terms
+
+
+def term_rows(books):
+    return [
+        {"term": term, "book_id": book.book_id, "weight": weight}
+        for book in books
+        for term, weight in book_terms(book).items()
+    ]
+
+
+async def index_new_books(db, books):
+    """Add index entries for books that have none yet, in one statement"""
+    rows = term_rows(books)
+    if rows:
+        await db.execute(insert(BookSearchTerm), rows)
+
+
+async def index_book(db, book):
+    """Replace the index entries of a book, within the caller's transaction"""
+    await unindex_book(db, book.book_id)
+    await index_new_books(db, [book])
+
+
+async def unindex_book(db, book_id):
+    await db.execute(delete(BookSearchTerm).where(BookSearchTerm.book_id == book_id))
+
+
+async def author_book_ids(db, author_id):
+    result = await db.scalars(
+        select(book_authors.c.book_id).where(book_authors.c.author_id == author_id)
+    )
+    return result.all()
+
+
+async def reindex_books(db, book_ids):
+    """Rebuild the entries of several books, e.g. after an author was renamed"""
+    if not book_ids:
+        return
+    books = await db.scalars(
+        select(Book).options(selectinload(Book.authors)).where(Book.book_id.in_(book_ids))
+    )
+    for book in books.all():
+        await index_book(db, book)
+
+
+def prefix_range(prefix):
+    """Conditions for terms starting with prefix, as a range of the term index
+
+    A LIKE with an escaped pattern is not always served by a range of the
+    index, the bounds always are.
+    """
+    conditions = [BookSearchTerm.term >= prefix]
+    last = ord(prefix[-1])
+    if last < sys.maxunicode:
+        conditions.append(BookSearchTerm.term < prefix[:-1] + chr(last + 1))
+    return and_(*conditions)
+
+
+def search_query(query, limit):
+    """Select the ids of the best matching books, most relevant first, or None for no words
+
+    Every word but the last must match a term exactly, the last one may be a
+    prefix, so partial input still finds results. A book matches when each
+    of the words matches one of its terms.
+    """
+    words = tokenize(query)
+    if not words:
+        return None
+    *exact, prefix = words
+    exact = sorted(set(exact))
+    matches_prefix = prefix_range(prefix)
+    statement = (
+        select(BookSearchTerm.book_id)
+        .group_by(BookSearchTerm.book_id)
+        .order_by(func.sum(BookSearchTerm.weight).desc(), BookSearchTerm.book_id)
+        .limit(limit)
+    )
+    if not exact:
+        return statement.where(matches_prefix)
+    return statement.where(or_(BookSearchTerm.term.in_(exact), matches_prefix)).having(and_(
+        func.count(distinct(case((BookSearchTerm.term.in_(exact), BookSearchTerm.term)))) == len(exact),
+        func.max(case((matches_prefix, 1), else_=0)) == 1,
+    ))
+
+
+async def search_book_ids(db, query, limit):
+    """Ids of the best matching books, most relevant first
+
+    All lookups go through the term primary key, so cost depends on the
+    matches rather than the size of the catalogue.
+    """
+    statement = search_query(query, limit)
+    if statement is None:
+        return []
+    return (await db.scalars(statement)).all()
+
+
+def rebuild_index(session, batch_size=1000):
+    """Index every book from scratch, for existing databases"""
+    session.execute(delete(BookSearchTerm))
+    last_id = 0
+    while True:
+        books = session.scalars(
+            select(Book)
+            .options(selectinload(Book.authors))
+            .where(Book.book_id > last_id)
+            .order_by(Book.book_id)
+            .limit(batch_size)
+        ).all()
+        if not books:
+            break
+        rows = term_rows(books)
+        if rows:
+            session.execute(insert(BookSearchTerm), rows)
+        session.commit()
+        session.expunge_all()
+        last_id = books[-1].book_id
+
+
+if __name__ == "__main__":
+    from app.database import SessionLocal
+
+    with SessionLocal() as session:
+        rebuild_index(session)
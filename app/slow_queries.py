@@ -0,0 +1,81 @@
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Longest parameter list written to the log, in characters
+MAX_PARAMETERS_LENGTH = 500
+
+# Placeholder lists of expanded IN clauses, which differ in length from one
+# execution to the next: IN (%s, %s, %s), IN (%(id_1_1)s, %(id_1_2)s) or IN (?, ?)
+_PLACEHOLDER = r"(?:%s|%\(\w+\)s|\?|:\w+)"
+_PLACEHOLDER_LIST = re.compile(rf"\bIN \({_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+# Statements the database can explain without running them
+_EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+
+def statement_shape(statement):
+    """The statement with whitespace and IN lists normalized, so that
+    executions that differ only in their parameters share a shape"""
+    return _PLACEHOLDER_LIST.sub("IN (...)", _WHITESPACE.sub(" ", statement).strip())
+
+
+class SlowQueryLog:
+    """Logs statements that take longer than threshold seconds
+
+    The first explain_limit slow executions of each statement shape also get
+    their plan logged. The EXPLAIN runs later, in a single background thread
+    and on a connection of its own from engine, so the request that ran the
+    statement never waits for it.
+    """
+
+    def __init__(self, engine, threshold, explain_limit=3):
+        self.engine = engine
+        self.threshold = threshold
+        self.explain_limit = explain_limit
+        self.count = 0
+        self.shapes = {}
+        self._lock = threading.Lock()
+        self._explainer = None
+
+    def record(self, statement, parameters, duration, route=None, executemany=False):
+        shape = statement_shape(statement)
+        with self._lock:
+            self.count += 1
+            seen = self.shapes.get(shape, 0)
+            self.shapes[shape] = seen + 1
+        logger.warning(
+            "Slow query: %.3fs route=%s statement=%s parameters=%s",
+            duration, route or "-", statement, repr(parameters)[:MAX_PARAMETERS_LENGTH]
+        )
+        explainable = shape.lstrip("(").upper().startswith(_EXPLAINABLE)
+        if seen < self.explain_limit and explainable and not executemany:
+            if self._explainer is None:
+                with self._lock:
+                    if self._explainer is None:
+                        self._explainer = ThreadPoolExecutor(1, thread_name_prefix="explain")
+            self._explainer.submit(self._explain, statement, parameters, shape)
+
+    def _explain(self, statement, parameters, shape):
+        prefix = "EXPLAIN QUERY PLAN " if self.engine.dialect.name == "sqlite" else "EXPLAIN "
+        try:
+            # The EXPLAIN itself is left out of the slow query log
+            with self.engine.connect() as conn:
+                result = conn.exec_driver_sql(
+                    prefix + statement, parameters or (),
+                    execution_options={"slow_query_log": False}
+                )
+                columns = list(result.keys())
+                plan = [dict(zip(columns, row)) for row in result]
+        except Exception:
+            logger.exception("Could not explain slow query: %s", shape)
+            return
+        logger.warning("Slow query plan: statement=%s plan=%s", shape, plan)
+
+    def stats(self):
+        with self._lock:
+            return {"slow_queries": self.count, "shapes": len(self.shapes)}
@@ -0,0 +1,146 @@
+"""Circulation statistics, kept in summary tables
+
+The loan endpoints add their changes to the counters in the same
+transaction, so the statistics endpoints read a few small rows instead of
+scanning the loan history. They do so last, after the book and member rows
+are updated: every loan transaction takes its locks in the order book,
+member, stats, so checkouts and returns cannot deadlock each other. To build
+the tables for an existing database, or to correct any drift, run:
+
+    python -m app.stats
+"""
+from collections import Counter
+from datetime import date
+
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from app.database import engine
+from app.models.loan import Loan
+from app.models.stats import BookLoanStats, CategoryDailyLoans, DailyCirculation
+
+# INSERT constructs that can add to a row which already exists
+_UPSERT_INSERTS = {
+    "mysql": mysql.insert,
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def increment(model, keys, rows):
+    """One statement adding the counters of each row to the row with the
+    same keys, or inserting it when there is none"""
+    table = model.__table__
+    counters = [name for name in rows[0] if name not in keys]
+    stmt = _UPSERT_INSERTS[engine.dialect.name](table).values(rows)
+    if engine.dialect.name == "mysql":
+        return stmt.on_duplicate_key_update({name: table.c[name] + stmt.inserted[name] for name in counters})
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={name: table.c[name] + stmt.excluded[name] for name in counters}
+    )
+
+
+async def _add(db, model, keys, rows):
+    rows = [row for row in rows if any(row[name] for name in row if name not in keys)]
+    if rows:
+        # Rows in key order, so that concurrent transactions lock them in the same order
+        rows.sort(key=lambda row: tuple(row[name] for name in keys))
+        await db.execute(increment(model, keys, rows))
+
+
+async def record_checkouts(db, loans):
+    """Count new loans, flushed but not yet committed
+
+    Each loan counts on the day the database stamped as its loan_date, which
+    is read back here, so that deleting the loan later takes it off the same
+    day. Call it last before committing: the day's rows are shared by every
+    checkout and stay locked until the commit.
+    """
+    loans = list(loans)
+    if not loans:
+        return
+    await db.flush()
+    days = dict((await db.execute(
+        select(Loan.loan_id, Loan.loan_date).where(Loan.loan_id.in_([loan.loan_id for loan in loans]))
+    )).all())
+    books, categories, circulation = Counter(), Counter(), Counter()
+    for loan in loans:
+        day = days[loan.loan_id]
+        books[loan.book_id] += 1
+        circulation[day] += 1
+        if loan.category_id is not None:
+            categories[loan.category_id, day] += 1
+    await _add(db, BookLoanStats, ["book_id"], [
+        {"book_id": book_id, "loans": n, "active_loans": n} for book_id, n in books.items()
+    ])
+    await _add(db, CategoryDailyLoans, ["category_id", "day"], [
+        {"category_id": category_id, "day": day, "loans": n} for (category_id, day), n in categories.items()
+    ])
+    await _add(db, DailyCirculation, ["day"], [
+        {"day": day, "loans": n, "returns": 0} for day, n in circulation.items()
+    ])
+
+
+async def record_returns(db, books, day=None):
+    """Count returned loans, given a Counter of book ids"""
+    day = day or date.today()
+    await _add(db, BookLoanStats, ["book_id"], [
+        {"book_id": book_id, "loans": 0, "active_loans": -n} for book_id, n in books.items()
+    ])
+    await _add(db, DailyCirculation, ["day"], [{"day": day, "loans": 0, "returns": sum(books.values())}])
+
+
+async def record_deleted_loan(db, loan):
+    """Take a deleted loan back out of the counters, under the category it was counted in"""
+    returned = loan.status == "returned"
+    await _add(db, BookLoanStats, ["book_id"], [
+        {"book_id": loan.book_id, "loans": -1, "active_loans": 0 if returned else -1}
+    ])
+    if loan.category_id is not None:
+        await _add(db, CategoryDailyLoans, ["category_id", "day"], [
+            {"category_id": loan.category_id, "day": loan.loan_date, "loans": -1}
+        ])
+    days = {loan.loan_date: {"day": loan.loan_date, "loans": -1, "returns": 0}}
+    if returned and loan.return_date is not None:
+        days.setdefault(loan.return_date, {"day": loan.return_date, "loans": 0, "returns": 0})["returns"] -= 1
+    await _add(db, DailyCirculation, ["day"], list(days.values()))
+
+
+def rebuild_stats(session):
+    """Recompute every summary table from the loans, in one transaction"""
+    for model in (BookLoanStats, CategoryDailyLoans, DailyCirculation):
+        session.execute(delete(model))
+
+    active = func.sum(case((Loan.status != "returned", 1), else_=0))
+    session.execute(insert(BookLoanStats).from_select(
+        ["book_id", "loans", "active_loans"],
+        select(Loan.book_id, func.count(), active).group_by(Loan.book_id)
+    ))
+    session.execute(insert(CategoryDailyLoans).from_select(
+        ["category_id", "day", "loans"],
+        select(Loan.category_id, Loan.loan_date, func.count())
+        .where(Loan.category_id.isnot(None))
+        .group_by(Loan.category_id, Loan.loan_date)
+    ))
+
+    days = {}
+    for day, n in session.execute(select(Loan.loan_date, func.count()).group_by(Loan.loan_date)):
+        days[day] = {"day": day, "loans": n, "returns": 0}
+    returned = (
+        select(Loan.return_date, func.count())
+        .where(Loan.status == "returned", Loan.return_date.isnot(None))
+        .group_by(Loan.return_date)
+    )
+    for day, n in session.execute(returned):
+        days.setdefault(day, {"day": day, "loans": 0, "returns": 0})["returns"] = n
+    if days:
+        session.execute(insert(DailyCirculation), list(days.values()))
+    session.commit()
+
+
+if __name__ == "__main__":
+    from app.database import SessionLocal
+
+    with SessionLocal() as session:
+        rebuild_stats(session)
@@ -0,0 +1,70 @@
+"""Cheap version queries for conditional requests
+
+Each query selects, per row, the columns that change whenever the response
+for that row would: its own version plus those of the entities embedded in
+it, and the updated_at stamps Last-Modified is taken from. They read a few
+narrow columns instead of the full rows.
+"""
+from sqlalchemy import func, select, update
+
+from app.models.author import Author
+from app.models.book import Book, book_authors
+from app.models.category import Category
+from app.models.loan import Loan
+from app.models.member import Member
+
+
+def book_version_columns():
+    """Version columns of a BookResponse, correlated to Book"""
+    category = Category.category_id == Book.category_id
+    authors = (
+        select(Author.author_id)
+        .join(book_authors, book_authors.c.author_id == Author.author_id)
+        .where(book_authors.c.book_id == Book.book_id)
+    )
+    return [
+        # Changing the set of authors bumps the book's version too
+        Book.version,
+        Book.updated_at,
+        select(Category.version).where(category).scalar_subquery(),
+        select(Category.updated_at).where(category).scalar_subquery(),
+        # A version only grows, so the total grows with any write to one of the authors
+        authors.with_only_columns(func.sum(Author.version)).scalar_subquery(),
+        authors.with_only_columns(func.max(Author.updated_at)).scalar_subquery(),
+    ]
+
+
+async def bump_book_versions(db, book_ids):
+    """Bump the versions of books whose set of authors changed, which their own rows do not show"""
+    if book_ids:
+        await db.execute(
+            update(Book)
+            .where(Book.book_id.in_(sorted(book_ids)))
+            .values(version=Book.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def author_version_query():
+    return select(Author.author_id, Author.version, Author.updated_at)
+
+
+def category_version_query():
+    return select(Category.category_id, Category.version, Category.updated_at)
+
+
+def member_version_query():
+    return select(Member.member_id, Member.version, Member.updated_at)
+
+
+def book_version_query():
+    return select(Book.book_id, *book_version_columns())
+
+
+def loan_version_query():
+    return (
+        select(Loan.loan_id, Loan.version, Loan.updated_at, Member.version, Member.updated_at,
+               *book_version_columns())
+        .join(Book, Book.book_id == Loan.book_id)
+        .join(Member, Member.member_id == Loan.member_id)
+    )
@@ -0,0 +1,172 @@
+"""Concurrency stress test for loan availability accounting
+
+Many threads check out and return a few popular titles at once, through the
+app, against a local database. A sampler watches that
+0 <= available_copies <= total_copies holds throughout, and at the end every
+book's available_copies must equal its total minus the loans still out.
+
+    python -m benchmarks.stress_loans --threads 32 --seconds 10
+    python -m benchmarks.stress_loans --database-url mysql+pymysql://... --async-db
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    parser.add_argument("--async-db", action="store_true", help="use the async engine")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--books", type=int, default=3, help="number of contended titles")
+    parser.add_argument("--copies", type=int, default=5, help="copies of each title")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--return-ratio", type=float, default=0.5,
+                        help="chance that a thread returns a book instead of borrowing one")
+    return parser.parse_args()
+
+
+def configure(args):
+    """Point the app at the test database, before it is imported"""
+    url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/stress.db"
+    os.environ["DATABASE_URL"] = url
+    os.environ["ASYNC_DB"] = "true" if args.async_db else "false"
+    os.environ.setdefault("DB_POOL_SIZE", str(args.threads))
+    return url
+
+
+def seed(args):
+    from app.database import SessionLocal
+    from app.models import Author, Book, Member
+
+    with SessionLocal() as session:
+        author = Author(first_name="Stress", last_name="Test")
+        books = [
+            Book(title=f"Popular title {i}", total_copies=args.copies, available_copies=args.copies, authors=[author])
+            for i in range(args.books)
+        ]
+        run_id = int(time.time())
+        members = [
+            Member(first_name="Member", last_name=str(i), email=f"stress{run_id}.{i}@example.com")
+            for i in range(args.members)
+        ]
+        session.add_all(books + members)
+        session.commit()
+        return [book.book_id for book in books], [member.member_id for member in members]
+
+
+def invariant_violations(connection, book_ids):
+    from sqlalchemy import func, select
+    from app.models import Book
+
+    return connection.execute(
+        select(func.count())
+        .select_from(Book)
+        .where(
+            Book.book_id.in_(book_ids),
+            (Book.available_copies < 0) | (Book.available_copies > Book.total_copies)
+        )
+    ).scalar()
+
+
+def final_check(book_ids):
+    """Books whose available_copies disagrees with the loans still out"""
+    from sqlalchemy import func, select
+    from app.database import engine
+    from app.models import Book, Loan
+
+    out = (
+        select(func.count())
+        .where(Loan.book_id == Book.book_id, Loan.status != 'returned')
+        .scalar_subquery()
+    )
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(Book.book_id, Book.available_copies, Book.total_copies, out)
+            .where(Book.book_id.in_(book_ids))
+        ).all()
+    return [row for row in rows if row[1] != row[2] - row[3]]
+
+
+def main():
+    args = parse_args()
+    url = configure(args)
+
+    # Imported only now, the app reads its settings at import time
+    from fastapi.testclient import TestClient
+    from app.database import engine
+    from app.main import app
+    from app.migrations import migrate
+
+    migrate(engine)
+    book_ids, member_ids = seed(args)
+    counts = Counter()
+    counts_lock = threading.Lock()
+    stop = threading.Event()
+    violations = []
+
+    def worker(client):
+        outstanding = []
+        local = Counter()
+        while not stop.is_set():
+            if outstanding and random.random() < args.return_ratio:
+                loan_id = outstanding.pop(random.randrange(len(outstanding)))
+                response = client.post(f"/loans/{loan_id}/return")
+                local["returned" if response.status_code == 200 else f"return {response.status_code}"] += 1
+            else:
+                response = client.post("/loans/", json={
+                    "book_id": random.choice(book_ids),
+                    "member_id": random.choice(member_ids),
+                    "due_date": "2099-01-01",
+                })
+                if response.status_code == 201:
+                    outstanding.append(response.json()["loan_id"])
+                    local["borrowed"] += 1
+                elif response.status_code == 400:
+                    local["unavailable"] += 1
+                else:
+                    local[f"checkout {response.status_code}"] += 1
+        with counts_lock:
+            counts.update(local)
+
+    def sampler():
+        with engine.connect() as connection:
+            while not stop.is_set():
+                found = invariant_violations(connection, book_ids)
+                if found:
+                    violations.append(found)
+                time.sleep(0.01)
+
+    with TestClient(app) as client:
+        threads = [threading.Thread(target=worker, args=(client,)) for _ in range(args.threads)]
+        threads.append(threading.Thread(target=sampler))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    mismatched = final_check(book_ids)
+    operations = sum(counts.values())
+    print(f"database:        {url}")
+    print(f"mode:            {'async' if args.async_db else 'sync'}, {args.threads} threads, "
+          f"{args.books} titles x {args.copies} copies")
+    print(f"operations:      {operations} in {elapsed:.1f}s ({operations / elapsed:.0f} ops/s)")
+    for outcome, n in sorted(counts.items()):
+        print(f"  {outcome + ':':<14} {n}")
+    print(f"invariant:       {'violated ' + str(len(violations)) + ' times' if violations else 'held'}")
+    print(f"final state:     {'%d books inconsistent: %s' % (len(mismatched), mismatched) if mismatched else 'consistent'}")
+    return 1 if violations or mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""Latency, throughput and query counts for every router
+
+Runs a fixed set of requests against each endpoint group, either in-process
+through the ASGI app or over HTTP against a running server, and records
+p50/p95/p99 latency, throughput and SQL statements per request. Results are
+written as JSON so runs can be compared. Seed a database with
+benchmarks.seed first; the write scenarios change it.
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --url http://localhost:8000 --concurrency 8 --output http.json
+    python -m benchmarks.suite --compare before.json after.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="defaults to the DATABASE_URL setting")
+    parser.add_argument("--async-db", action="store_true", help="use the async engine in-process")
+    parser.add_argument("--url", help="benchmark a running server instead of the app in-process")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--only", help="run the scenarios whose name contains this")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the request mix")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two result files and exit")
+    parser.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+class Scenario:
+    """A named request, built afresh for every call from the shared context"""
+
+    def __init__(self, name, method, make, expect=(200,)):
+        self.name = name
+        self.method = method
+        self.make = make
+        self.expect = expect
+
+    def request(self, ctx):
+        made = self.make(ctx)
+        path, body = made if isinstance(made, tuple) else (made, None)
+        return self.method, path, body
+
+
+class Context:
+    """Ids present in the database, and loans created during the run"""
+
+    def __init__(self, connection, seed):
+        from sqlalchemy import func, select
+        from app.models import Author, Book, Category, Loan, Member
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.run = datetime.now().strftime("%Y%m%d%H%M%S")
+
+        def ids(column, *where):
+            return connection.execute(select(column).where(*where).order_by(column).limit(100000)).scalars().all()
+
+        self.authors = ids(Author.author_id)
+        self.categories = ids(Category.category_id)
+        self.books = ids(Book.book_id)
+        self.members = ids(Member.member_id)
+        self.active_members = ids(Member.member_id, Member.membership_status == 'active')
+        self.loans = ids(Loan.loan_id)
+        self.outstanding = deque(ids(Loan.loan_id, Loan.status != 'returned'))
+        self.counts = {
+            table: connection.execute(select(func.count()).select_from(model)).scalar()
+            for table, model in [("authors", Author), ("categories", Category), ("books", Book),
+                                 ("members", Member), ("loans", Loan)]
+        }
+        if not (self.authors and self.categories and self.books and self.active_members and self.loans):
+            raise SystemExit("The database is empty, seed it with: python -m benchmarks.seed")
+
+    def pick(self, ids):
+        with self.lock:
+            return self.rng.choice(ids)
+
+    def unique(self):
+        return f"{self.run}.{next(self.counter)}"
+
+    def take_outstanding(self):
+        with self.lock:
+            return self.outstanding.popleft() if self.outstanding else self.rng.choice(self.loans)
+
+
+def created_loan(ctx, response):
+    if response.status_code == 201:
+        with ctx.lock:
+            ctx.outstanding.append(response.json()["loan_id"])
+
+
+SEARCH_WORDS = ["river", "night", "garden", "the shadow", "win", "okafor", "press"]
+DUE = (date.today() + timedelta(days=14)).isoformat()
+YEAR_AGO = (date.today() - timedelta(days=365)).isoformat()
+
+SCENARIOS = [
+    Scenario("health", "GET", lambda ctx: "/health"),
+    Scenario("authors.list", "GET", lambda ctx: "/authors/?limit=100"),
+    Scenario("authors.read", "GET", lambda ctx: f"/authors/{ctx.pick(ctx.authors)}"),
+    Scenario("authors.create", "POST", lambda ctx: ("/authors/", {
+        "first_name": "Bench", "last_name": ctx.unique(), "nationality": "Kenyan",
+    }), expect=(201,)),
+    Scenario("authors.update", "PUT", lambda ctx: (f"/authors/{ctx.pick(ctx.authors)}", {
+        "biography": f"Updated {ctx.unique()}",
+    })),
+    Scenario("categories.list", "GET", lambda ctx: "/categories/"),
+    Scenario("categories.read", "GET", lambda ctx: f"/categories/{ctx.pick(ctx.categories)}"),
+    Scenario("books.list", "GET", lambda ctx: "/books/?limit=100"),
+    Scenario("books.list.category", "GET", lambda ctx: f"/books/?limit=100&category_id={ctx.pick(ctx.categories)}"),
+    Scenario("books.list.fields", "GET", lambda ctx: "/books/?limit=100&fields=book_id,title,available_copies"),
+    Scenario("books.read", "GET", lambda ctx: f"/books/{ctx.pick(ctx.books)}"),
+    Scenario("books.search", "GET", lambda ctx: f"/books/search?q={ctx.pick(SEARCH_WORDS)}"),
+    Scenario("books.create", "POST", lambda ctx: ("/books/", {
+        "title": f"Benchmark {ctx.unique()}", "total_copies": 2,
+        "category_id": ctx.pick(ctx.categories), "author_ids": [ctx.pick(ctx.authors)],
+    }), expect=(201,)),
+    Scenario("books.update", "PUT", lambda ctx: (f"/books/{ctx.pick(ctx.books)}", {
+        "publisher": f"Press {ctx.unique()}",
+    })),
+    Scenario("books.export", "GET", lambda ctx: f"/books/export?category_id={ctx.pick(ctx.categories)}"),
+    Scenario("members.list", "GET", lambda ctx: "/members/?limit=100"),
+    Scenario("members.read", "GET", lambda ctx: f"/members/{ctx.pick(ctx.members)}"),
+    Scenario("members.summary", "GET", lambda ctx: f"/members/{ctx.pick(ctx.members)}/summary"),
+    Scenario("members.create", "POST", lambda ctx: ("/members/", {
+        "first_name": "Bench", "last_name": "Member", "email": f"bench.{ctx.unique()}@example.com",
+    }), expect=(201,)),
+    Scenario("loans.list", "GET", lambda ctx: "/loans/?limit=100"),
+    Scenario("loans.list.expanded", "GET", lambda ctx: "/loans/?limit=100&expand=book.authors,member"),
+    Scenario("loans.list.member", "GET", lambda ctx: f"/loans/?member_id={ctx.pick(ctx.members)}"),
+    Scenario("loans.read", "GET", lambda ctx: f"/loans/{ctx.pick(ctx.loans)}?expand=book,member"),
+    # Titles run out of copies, so some checkouts are turned away
+    Scenario("loans.create", "POST", lambda ctx: ("/loans/", {
+        "book_id": ctx.pick(ctx.books), "member_id": ctx.pick(ctx.active_members), "due_date": DUE,
+    }), expect=(201, 400)),
+    Scenario("loans.return", "POST", lambda ctx: f"/loans/{ctx.take_outstanding()}/return", expect=(200, 400)),
+    Scenario("loans.export", "GET", lambda ctx: f"/loans/export?member_id={ctx.pick(ctx.members)}"),
+    Scenario("stats.most_borrowed", "GET", lambda ctx: "/stats/most-borrowed"),
+    Scenario("stats.busiest_categories", "GET", lambda ctx: f"/stats/busiest-categories?start={YEAR_AGO}"),
+    Scenario("stats.loans_per_day", "GET", lambda ctx: "/stats/loans-per-day"),
+]
+
+
+class QueryCounter:
+    """Counts SQL statements sent by the app's engines, in-process only"""
+
+    def __init__(self, engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        self.lock = threading.Lock()
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self.increment)
+
+    def increment(self, *args):
+        with self.lock:
+            self.count += 1
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an ascending list"""
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def run_scenario(client, scenario, ctx, args, queries):
+    def call(_):
+        method, path, body = scenario.request(ctx)
+        started = time.perf_counter()
+        response = client.request(method, path, json=body)
+        elapsed = time.perf_counter() - started
+        if scenario.name == "loans.create":
+            created_loan(ctx, response)
+        return elapsed, response.status_code
+
+    for _ in range(args.warmup):
+        call(None)
+    before = queries.count if queries else None
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(call, range(args.requests)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _ in results)
+    statuses = Counter(str(status) for _, status in results)
+    return {
+        "requests": len(results),
+        "throughput_rps": round(len(results) / wall, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "mean": round(sum(latencies) / len(latencies), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "queries_per_request": round((queries.count - before) / len(results), 2) if queries else None,
+        "statuses": dict(statuses),
+        "unexpected": sum(n for status, n in statuses.items() if int(status) not in scenario.expect),
+    }
+
+
+def probe_startup():
+    """Time importing the app, its startup hooks and its first request, in
+    the fresh process measure_startup starts, and print them as JSON"""
+    started = time.perf_counter()
+    from app.main import app
+    imported = time.perf_counter()
+    from fastapi.testclient import TestClient
+    with TestClient(app) as client:
+        ready = time.perf_counter()
+        client.get("/health")
+        answered = time.perf_counter()
+    print(json.dumps({
+        "import_seconds": round(imported - started, 3),
+        "startup_seconds": round(ready - imported, 3),
+        "first_request_seconds": round(answered - ready, 3),
+    }))
+    return 0
+
+
+def measure_startup():
+    """Startup timings of a new process, which has nothing imported or connected yet"""
+    started = time.perf_counter()
+    probe = subprocess.run(
+        [sys.executable, "-m", "benchmarks.suite", "--startup-probe"],
+        capture_output=True, text=True, check=True
+    )
+    timings = json.loads(probe.stdout.strip().splitlines()[-1])
+    timings["process_seconds"] = round(time.perf_counter() - started, 3)
+    return timings
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'scenario':<24} {'p50 ms':>18} {'p95 ms':>18} {'rps':>18} {'queries':>12}")
+
+    def delta(old, new):
+        if old is None or new is None:
+            return f"{'-':>18}"
+        change = (new - old) / old * 100 if old else 0
+        return f"{new:>9.2f} ({change:+5.0f}%)"
+
+    for name, new in after["scenarios"].items():
+        old = before["scenarios"].get(name)
+        if old is None:
+            continue
+        print(
+            f"{name:<24} {delta(old['latency_ms']['p50'], new['latency_ms']['p50'])}"
+            f" {delta(old['latency_ms']['p95'], new['latency_ms']['p95'])}"
+            f" {delta(old['throughput_rps'], new['throughput_rps'])}"
+            f" {str(old['queries_per_request']) + ' -> ' + str(new['queries_per_request']):>12}"
+        )
+    return 0
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        return compare(*args.compare)
+    if args.startup_probe:
+        return probe_startup()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    os.environ["ASYNC_DB"] = "true" if args.async_db else os.environ.get("ASYNC_DB", "false")
+    os.environ.setdefault("DB_POOL_SIZE", str(max(5, args.concurrency)))
+
+    # Imported only now, the app reads its settings at import time
+    from app.database import async_engine, engine
+
+    with engine.connect() as connection:
+        ctx = Context(connection, args.seed)
+
+    startup = None
+    queries = None
+    if args.url:
+        import httpx
+        client = httpx.Client(base_url=args.url, timeout=60)
+    else:
+        # Measured in a process of its own, this one has already imported and connected
+        startup = measure_startup()
+        print(
+            f"{'startup':<24} process {startup['process_seconds']:.3f}s  import {startup['import_seconds']:.3f}s"
+            f"  hooks {startup['startup_seconds']:.3f}s  first request {startup['first_request_seconds']:.3f}s"
+        )
+        from fastapi.testclient import TestClient
+        from app.main import app
+        client = TestClient(app)
+        client.__enter__()
+        queries = QueryCounter([engine] + ([async_engine.sync_engine] if async_engine else []))
+
+    scenarios = [s for s in SCENARIOS if not args.only or args.only in s.name]
+    results = {}
+    try:
+        for scenario in scenarios:
+            results[scenario.name] = result = run_scenario(client, scenario, ctx, args, queries)
+            latency = result["latency_ms"]
+            print(
+                f"{scenario.name:<24} p50 {latency['p50']:8.2f}  p95 {latency['p95']:8.2f}"
+                f"  p99 {latency['p99']:8.2f} ms  {result['throughput_rps']:8.1f} rps"
+                f"  {result['queries_per_request'] if queries else '-'!s:>6} q/req"
+                + (f"  {result['unexpected']} unexpected" if result["unexpected"] else "")
+            )
+    finally:
+        if args.url:
+            client.close()
+        else:
+            client.__exit__(None, None, None)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "target": args.url or "in-process",
+        "database": engine.url.render_as_string(hide_password=True),
+        "async_db": args.async_db,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "seed": args.seed,
+        "dataset": ctx.counts,
+        "startup": startup,
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+    return 1 if any(result["unexpected"] for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""The app on a throwaway SQLite database, in both session modes
+
+The app reads its settings when it is imported, so the environment is set up
+here, before any test module imports it. The entity cache is off, so that
+every request reaches the database.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+DATA_DIR = tempfile.mkdtemp(prefix="library-tests-")
+PRIMARY_URL = f"sqlite:///{DATA_DIR}/primary.db"
+os.environ.update(
+    DATABASE_URL=PRIMARY_URL,
+    DATABASE_REPLICA_URLS="",
+    ASYNC_DB="false",
+    CACHE_BACKEND="none",
+    ADMISSION_CONTROL="false",
+)
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import database
+from app.config import settings
+from app.main import app
+from app.migrations import migrate
+from app.pool import InstrumentedAsyncPool
+
+
+@pytest.fixture(scope="session")
+def library():
+    """Ids of a small catalogue with loans, created once through the API"""
+    migrate(database.engine)
+    with TestClient(app) as client:
+        categories = [
+            client.post("/categories/", json={"name": name}).json()["category_id"]
+            for name in ("Fiction", "History")
+        ]
+        authors = [
+            client.post("/authors/", json={"first_name": f"First{i}", "last_name": f"Last{i}"}).json()["author_id"]
+            for i in range(4)
+        ]
+        books = [
+            client.post("/books/", json={
+                "title": f"Book {i}",
+                "isbn": f"isbn-{i}",
+                "total_copies": 3,
+                "category_id": categories[i % 2],
+                "author_ids": [authors[i % 4], authors[(i + 1) % 4]],
+            }).json()["book_id"]
+            for i in range(6)
+        ]
+        members = [
+            client.post("/members/", json={
+                "first_name": "Member", "last_name": str(i), "email": f"member{i}@example.com"
+            }).json()["member_id"]
+            for i in range(2)
+        ]
+        due_date = str(date.today() + timedelta(days=14))
+        loans = [
+            client.post("/loans/", json={
+                "book_id": book_id, "member_id": members[i % 2], "due_date": due_date
+            }).json()["loan_id"]
+            for i, book_id in enumerate(books)
+        ]
+    return {"categories": categories, "authors": authors, "books": books, "members": members, "loans": loans}
+
+
+@pytest.fixture(params=["sync", "async"])
+def db_mode(request, monkeypatch):
+    """Serve requests through ThreadedSession on the sync engine, or AsyncSession with ASYNC_DB
+
+    Yields the sync engine the statements of the mode run on.
+    """
+    if request.param == "sync":
+        yield database.engine
+        return
+    async_engine = create_async_engine(
+        database.make_async_url(PRIMARY_URL), **database.engine_options(PRIMARY_URL, InstrumentedAsyncPool)
+    )
+    monkeypatch.setattr(settings, "async_db", True)
+    monkeypatch.setattr(database, "async_engine", async_engine)
+    monkeypatch.setattr(database, "AsyncSessionLocal", sessionmaker(
+        async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    ))
+    yield async_engine.sync_engine
+
+
+@pytest.fixture
+def client(library, db_mode):
+    with TestClient(app) as client:
+        yield client
+        if database.async_engine is not None:
+            client.portal.call(database.async_engine.dispose)
+
+
+class StatementCounter:
+    """Counts the statements an engine sends to the database"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @contextmanager
+    def __call__(self):
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, "before_cursor_execute", self._record)
+
+    def __len__(self):
+        return len(self.statements)
+
+
+@pytest.fixture
+def count_statements(db_mode):
+    """Context manager counting the statements run inside it, in the current mode"""
+    return StatementCounter(db_mode)
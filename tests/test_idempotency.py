@@ -0,0 +1,105 @@
+"""Retries of creates sent with an Idempotency-Key"""
+import asyncio
+from itertools import count
+
+from fastapi import Response
+from pydantic import BaseModel
+
+from app.cache import LRUCache
+from app.idempotency import REPLAYED_HEADER, IdempotencyStore
+from tests.test_loans import DUE_DATE, available_copies, new_book, new_member
+
+_keys = count()
+
+
+def new_key():
+    return f"kiosk-{next(_keys)}"
+
+
+def test_retry_gets_the_first_response(client, library):
+    book_id, member_id = new_book(client, library), new_member(client)
+    loan = {"book_id": book_id, "member_id": member_id, "due_date": DUE_DATE}
+    headers = {"Idempotency-Key": new_key()}
+
+    first = client.post("/loans/", json=loan, headers=headers)
+    retry = client.post("/loans/", json=loan, headers=headers)
+
+    assert first.status_code == retry.status_code == 201
+    assert retry.json() == first.json()
+    assert REPLAYED_HEADER not in first.headers
+    assert retry.headers[REPLAYED_HEADER] == "true"
+    # The book went out once
+    assert available_copies(client, book_id) == 0
+    assert client.get(f"/members/{member_id}/summary").json()["active_loans"] == 1
+
+
+def test_retry_gets_the_first_client_error(client, library):
+    book_id = new_book(client, library)
+    taken = {"book_id": book_id, "member_id": new_member(client), "due_date": DUE_DATE}
+    assert client.post("/loans/", json=taken).status_code == 201
+    loan = {"book_id": book_id, "member_id": new_member(client), "due_date": DUE_DATE}
+    headers = {"Idempotency-Key": new_key()}
+
+    first = client.post("/loans/", json=loan, headers=headers)
+    # Even once a copy is back, the retry answers as the first request did
+    assert client.put(f"/books/{book_id}", json={"total_copies": 2, "available_copies": 1}).status_code == 200
+    retry = client.post("/loans/", json=loan, headers=headers)
+
+    assert first.status_code == retry.status_code == 400
+    assert retry.json() == first.json()
+    assert retry.headers[REPLAYED_HEADER] == "true"
+
+
+def test_key_reused_with_another_body_is_rejected(client, library):
+    member_id = new_member(client)
+    headers = {"Idempotency-Key": new_key()}
+    first = client.post("/loans/", json={
+        "book_id": new_book(client, library), "member_id": member_id, "due_date": DUE_DATE
+    }, headers=headers)
+    other_book = new_book(client, library)
+
+    response = client.post("/loans/", json={
+        "book_id": other_book, "member_id": member_id, "due_date": DUE_DATE
+    }, headers=headers)
+
+    assert first.status_code == 201
+    assert response.status_code == 422
+    assert available_copies(client, other_book) == 1
+
+
+def test_different_keys_run_separately(client):
+    key = new_key()
+    member = {"first_name": "Key", "last_name": "Twice", "email": f"{key}@example.com"}
+    assert client.post("/members/", json=member, headers={"Idempotency-Key": key}).status_code == 201
+    # A new key is a new request, which finds the email taken
+    assert client.post("/members/", json=member, headers={"Idempotency-Key": new_key()}).status_code == 400
+
+
+class Created(BaseModel):
+    created: int
+
+
+def test_concurrent_duplicates_run_once():
+    store = IdempotencyStore(LRUCache(max_entries=10, ttl=60))
+    calls = []
+
+    async def execute():
+        calls.append(None)
+        # Let the duplicates arrive while the first request is still running
+        await asyncio.sleep(0.05)
+        return {"created": len(calls)}
+
+    async def send():
+        response = Response()
+        result = await store.run("loans:kiosk", Created(created=0), response, execute, Created)
+        return result, response.headers.get(REPLAYED_HEADER)
+
+    async def main():
+        return await asyncio.gather(*(send() for _ in range(5)))
+
+    outcomes = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert [result for result, _ in outcomes] == [{"created": 1}] * 5
+    assert sorted(replayed or "" for _, replayed in outcomes) == [""] + ["true"] * 4
+    assert not store.in_flight
@@ -0,0 +1,139 @@
+"""Copies and counters kept in step by checkouts, returns and loan updates
+
+Each test checks out its own book to its own members, so the counts it reads
+are not disturbed by the catalogue other tests share.
+"""
+from datetime import date, timedelta
+from itertools import count
+
+from app import stats
+from app.config import settings
+
+DUE_DATE = str(date.today() + timedelta(days=14))
+
+_ids = count()
+
+
+def new_book(client, library, copies=1):
+    n = next(_ids)
+    response = client.post("/books/", json={
+        "title": f"Loan test {n}", "isbn": f"loans-{n}", "total_copies": copies,
+        "category_id": library["categories"][0], "author_ids": library["authors"][:1]
+    })
+    assert response.status_code == 201
+    return response.json()["book_id"]
+
+
+def new_member(client):
+    n = next(_ids)
+    response = client.post("/members/", json={
+        "first_name": "Loan", "last_name": f"Test{n}", "email": f"loans{n}@example.com"
+    })
+    assert response.status_code == 201
+    return response.json()["member_id"]
+
+
+def check_out(client, book_id, member_id):
+    return client.post("/loans/", json={"book_id": book_id, "member_id": member_id, "due_date": DUE_DATE})
+
+
+def available_copies(client, book_id):
+    return client.get(f"/books/{book_id}").json()["available_copies"]
+
+
+def test_returned_loan_cannot_be_reopened(client, library):
+    book_id = new_book(client, library)
+    first, second = new_member(client), new_member(client)
+    loan_id = check_out(client, book_id, first).json()["loan_id"]
+    assert client.put(f"/loans/{loan_id}", json={"status": "returned"}).status_code == 200
+
+    response = client.put(f"/loans/{loan_id}", json={"status": "borrowed"})
+
+    assert response.status_code == 400
+    assert client.get(f"/loans/{loan_id}").json()["status"] == "returned"
+    assert available_copies(client, book_id) == 1
+    assert client.get(f"/members/{first}/summary").json()["active_loans"] == 0
+    # The copy is still there for the next member, and only one of them
+    assert check_out(client, book_id, second).status_code == 201
+    assert check_out(client, book_id, first).status_code == 400
+    assert available_copies(client, book_id) == 0
+
+
+def loans_per_day(client, start, end):
+    days = client.get("/stats/loans-per-day", params={"start": str(start), "end": str(end)}).json()
+    return {day["day"]: day["loans"] for day in days}
+
+
+def test_checkouts_count_on_the_stored_loan_date(client, library, monkeypatch):
+    class Tomorrow(date):
+        """The app's clock a day ahead of the database's"""
+        @classmethod
+        def today(cls):
+            return date.today() + timedelta(days=1)
+
+    monkeypatch.setattr(stats, "date", Tomorrow)
+    start, end = date.today() - timedelta(days=1), date.today() + timedelta(days=2)
+    before = loans_per_day(client, start, end)
+    loan = check_out(client, new_book(client, library), new_member(client)).json()
+
+    after = loans_per_day(client, start, end)
+    assert after == {**before, loan["loan_date"]: before[loan["loan_date"]] + 1}
+    # Deleting the loan takes it off the same day
+    assert client.delete(f"/loans/{loan['loan_id']}").status_code == 204
+    assert loans_per_day(client, start, end) == before
+
+
+def summary(client, member_id):
+    return client.get(f"/members/{member_id}/summary").json()
+
+
+def test_loan_limit(client, library, monkeypatch):
+    monkeypatch.setattr(settings, "max_active_loans", 2)
+    member_id = new_member(client)
+    books = [new_book(client, library) for _ in range(4)]
+    loans = [check_out(client, book_id, member_id).json()["loan_id"] for book_id in books[:2]]
+
+    response = check_out(client, books[2], member_id)
+
+    assert response.status_code == 400
+    assert available_copies(client, books[2]) == 1
+    assert summary(client, member_id) == {
+        "member_id": member_id, "membership_status": "active", "active_loans": 2, "overdue_loans": 0,
+        "outstanding_fines": 0, "max_active_loans": 2, "can_borrow": False
+    }
+    # A bulk checkout over the limit takes nothing
+    bulk = client.post("/loans/bulk", json={"member_id": member_id, "book_ids": books[2:], "due_date": DUE_DATE})
+    assert bulk.status_code == 400
+    assert [available_copies(client, book_id) for book_id in books[2:]] == [1, 1]
+    # A return makes room for one more
+    assert client.post(f"/loans/{loans[0]}/return").status_code == 200
+    assert summary(client, member_id)["can_borrow"]
+    assert check_out(client, books[2], member_id).status_code == 201
+    assert check_out(client, books[3], member_id).status_code == 400
+
+
+def test_summary_counters_follow_the_loans(client, library):
+    member_id = new_member(client)
+    late = client.post("/loans/", json={
+        "book_id": new_book(client, library), "member_id": member_id,
+        "due_date": str(date.today() - timedelta(days=4))
+    }).json()["loan_id"]
+    on_time = check_out(client, new_book(client, library), member_id).json()["loan_id"]
+    assert summary(client, member_id)["active_loans"] == 2
+
+    assert client.put(f"/loans/{late}", json={"status": "overdue"}).status_code == 200
+    assert (summary(client, member_id)["active_loans"], summary(client, member_id)["overdue_loans"]) == (2, 1)
+
+    # Returned four days late, at 0.50 a day
+    assert client.post(f"/loans/{late}/return").json()["fine_amount"] == 2
+    counters = summary(client, member_id)
+    assert (counters["active_loans"], counters["overdue_loans"], counters["outstanding_fines"]) == (1, 0, 2)
+
+    assert client.put(f"/loans/{on_time}", json={"fine_amount": "1.50"}).status_code == 200
+    assert summary(client, member_id)["outstanding_fines"] == 3.5
+    assert client.delete(f"/loans/{on_time}").status_code == 204
+    counters = summary(client, member_id)
+    assert (counters["active_loans"], counters["overdue_loans"], counters["outstanding_fines"]) == (0, 0, 2)
+    # Reopening the returned loan through PUT would skip the limit, so it is refused
+    assert client.put(f"/loans/{late}", json={"status": "borrowed"}).status_code == 400
+    assert summary(client, member_id)["active_loans"] == 0
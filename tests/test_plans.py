@@ -0,0 +1,46 @@
+"""Query plans of the list filters and book search, on a seeded SQLite database
+
+The checks are those of benchmarks.plans. Plans depend on the data, so they
+run against a database of their own, seeded with benchmarks.seed, rather
+than the handful of rows the other tests share.
+"""
+from argparse import Namespace
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.migrations import migrate
+from app.search import rebuild_index
+from app.stats import rebuild_stats
+from benchmarks.plans import check_plan, checks
+from benchmarks.seed import generate
+
+CHECKS = checks()
+
+
+@pytest.fixture(scope="module")
+def seeded(tmp_path_factory):
+    """A connection to a database seeded with a small catalogue and loan history"""
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('plans') / 'seeded.db'}")
+    migrate(engine)
+    with engine.begin() as connection:
+        generate(connection, Namespace(
+            authors=300, books=2000, members=500, loans=10000,
+            skew=1.1, seed=42, batch_size=5000, today=date.today()
+        ))
+    with Session(engine, autoflush=False, expire_on_commit=False) as session:
+        rebuild_index(session)
+        rebuild_stats(session)
+    with engine.connect() as connection:
+        yield connection
+    engine.dispose()
+
+
+@pytest.mark.parametrize("query, table, expected", [
+    pytest.param(query, table, expected, id=name) for name, query, (table, expected) in CHECKS
+])
+def test_plan_reads_table_as_expected(seeded, query, table, expected):
+    ok, plan, alternatives = check_plan(seeded, query, table, expected)
+    assert ok, f"expected {table}: {' or '.join(alternatives)}, got {[row['detail'] for row in plan]}"
@@ -0,0 +1,47 @@
+"""Statements per request of the book and loan reads
+
+Each read runs a fixed number of statements, however many rows it returns:
+one for the version the ETag is built from, one for the rows, and one per
+relationship loaded for all of them at once.
+"""
+import pytest
+
+
+@pytest.mark.parametrize("path, expected", [
+    # version, books, their categories, their authors
+    ("/books/", 4),
+    # version, book with its category, its authors
+    ("/books/{book}", 3),
+    # version, loans
+    ("/loans/", 2),
+    ("/loans/{loan}", 2),
+    # plus books, their authors and members
+    ("/loans/?expand=book.authors,member", 5),
+    ("/loans/{loan}?expand=book.authors,member", 5),
+])
+def test_statements_per_read(client, count_statements, library, path, expected):
+    path = path.format(book=library["books"][0], loan=library["loans"][0])
+    with count_statements() as statements:
+        response = client.get(path)
+    assert response.status_code == 200
+    assert len(statements) == expected, statements.statements
+
+
+@pytest.mark.parametrize("path", ["/books/", "/loans/", "/loans/?expand=book.authors,member"])
+def test_list_statements_do_not_grow_with_the_page(client, count_statements, path):
+    separator = "&" if "?" in path else "?"
+    with count_statements() as one_row:
+        assert len(client.get(f"{path}{separator}limit=1").json()) == 1
+    with count_statements() as all_rows:
+        assert len(client.get(path).json()) > 1
+    assert len(all_rows) == len(one_row)
+
+
+@pytest.mark.parametrize("path", ["/books/{book}", "/loans/{loan}", "/books/"])
+def test_not_modified_reads_only_the_version(client, count_statements, library, path):
+    path = path.format(book=library["books"][0], loan=library["loans"][0])
+    etag = client.get(path).headers["etag"]
+    with count_statements() as statements:
+        response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(statements) == 1
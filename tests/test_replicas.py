@@ -0,0 +1,142 @@
+"""Read routing to replicas, with a copy of the primary SQLite file as the replica
+
+The copy is taken when the test starts and never replicated to afterwards,
+so a row written later is only found on the primary.
+"""
+import shutil
+import time
+
+import pytest
+from sqlalchemy import select
+
+from app import conditional, database
+from app.cache import LRUCache, entity_key
+from app.database import READ_PRIMARY_COOKIE, ReplicaSet
+from app.models.author import Author
+from app.routes import authors
+
+
+@pytest.fixture
+def use_replicas(client, monkeypatch):
+    """Route reads to replicas at the given URLs for the rest of the test"""
+    created = []
+
+    def use(*urls):
+        replicas = ReplicaSet(urls)
+        created.append(replicas)
+        monkeypatch.setattr(database, "replicas", replicas)
+        return replicas
+
+    yield use
+    for replicas in created:
+        for replica in replicas.replicas:
+            replica.engine.dispose()
+            if replica.async_engine is not None:
+                client.portal.call(replica.async_engine.dispose)
+
+
+def snapshot(tmp_path):
+    """URL of a copy of the primary database as it is now"""
+    path = tmp_path / "replica.db"
+    shutil.copy(database.engine.url.database, path)
+    return f"sqlite:///{path}"
+
+
+@pytest.fixture
+def replica_url(tmp_path):
+    return snapshot(tmp_path)
+
+
+def author_on(engine, author_id):
+    with engine.connect() as connection:
+        return connection.execute(select(Author.author_id).where(Author.author_id == author_id)).scalar()
+
+
+def add_author_to_primary():
+    """An author only the primary has, written without going through the API"""
+    with database.engine.begin() as connection:
+        return connection.execute(
+            Author.__table__.insert().values(first_name="Primary", last_name="Only")
+        ).inserted_primary_key[0]
+
+
+def test_reads_go_to_the_replica(client, use_replicas, replica_url):
+    replicas = use_replicas(replica_url)
+    author_id = add_author_to_primary()
+
+    assert client.get(f"/authors/{author_id}").status_code == 404
+    assert client.get("/authors/", params={"limit": 1}).status_code == 200
+    assert replicas.replicas[0].healthy
+
+
+def test_writes_go_to_the_primary(client, use_replicas, replica_url):
+    replicas = use_replicas(replica_url)
+
+    response = client.post("/authors/", json={"first_name": "New", "last_name": "Author"})
+
+    assert response.status_code == 201
+    author_id = response.json()["author_id"]
+    assert author_on(database.engine, author_id) == author_id
+    assert author_on(replicas.replicas[0].engine, author_id) is None
+
+
+def test_reads_after_a_write_go_to_the_primary(client, use_replicas, replica_url):
+    use_replicas(replica_url)
+
+    author_id = client.post("/authors/", json={"first_name": "New", "last_name": "Author"}).json()["author_id"]
+
+    # The writer's next read is pinned to the primary by the cookie
+    assert READ_PRIMARY_COOKIE in client.cookies
+    assert client.get(f"/authors/{author_id}").status_code == 200
+    # Without it, the read goes to the replica, which has not seen the write
+    client.cookies.clear()
+    assert client.get(f"/authors/{author_id}").status_code == 404
+
+
+def test_unreachable_replica_is_ejected(client, use_replicas, replica_url, tmp_path):
+    missing = f"sqlite:///{tmp_path / 'missing' / 'replica.db'}"
+    replicas = use_replicas(missing, replica_url)
+    unreachable, reachable = replicas.replicas
+    author_id = add_author_to_primary()
+
+    # The first read picks the unreachable replica, ejects it and moves on to the next
+    assert client.get(f"/authors/{author_id}").status_code == 404
+    assert not unreachable.healthy
+    assert unreachable.ejections == 1
+    assert reachable.healthy
+    # Later reads skip it
+    for _ in range(3):
+        assert client.get(f"/authors/{author_id}").status_code == 404
+    assert unreachable.ejections == 1
+    assert [replica["healthy"] for replica in replicas.status()] == [False, True]
+
+
+def test_all_replicas_ejected_reads_go_to_the_primary(client, use_replicas, tmp_path):
+    replicas = use_replicas(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    author_id = add_author_to_primary()
+
+    assert client.get(f"/authors/{author_id}").status_code == 200
+    assert not replicas.replicas[0].healthy
+
+
+def test_replica_reads_do_not_fill_the_cache(client, use_replicas, tmp_path, monkeypatch):
+    shared = LRUCache(max_entries=100, ttl=60)
+    monkeypatch.setattr(conditional, "cache", shared)
+    monkeypatch.setattr(authors, "cache", shared)
+    author_id = client.post("/authors/", json={"first_name": "Before", "last_name": "Rename"}).json()["author_id"]
+    use_replicas(snapshot(tmp_path))
+    key = entity_key("author", author_id)
+
+    # The rename reaches the primary only, and drops the cached author
+    assert client.put(f"/authors/{author_id}", json={"first_name": "After"}).status_code == 200
+    client.cookies.clear()
+
+    # Another client reads the old name from the replica, which must not cache it
+    assert client.get(f"/authors/{author_id}").json()["first_name"] == "Before"
+    assert shared.get(key) is None
+    # A read from the primary does, and every client gets the new name from then on
+    client.cookies.set(READ_PRIMARY_COOKIE, f"{time.time() + 60:.3f}")
+    assert client.get(f"/authors/{author_id}").json()["first_name"] == "After"
+    assert shared.get(key)["body"]["first_name"] == "After"
+    client.cookies.clear()
+    assert client.get(f"/authors/{author_id}").json()["first_name"] == "After"